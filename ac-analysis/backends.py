@@ -0,0 +1,123 @@
+"""Calls to the backend functions, with deadlines, retries, hedging and circuit breaking
+
+Settings are read from environment variables per backend function, e.g. SONIC_ANNOTATOR_TIMEOUT,
+falling back to the BACKEND_ ones, e.g. BACKEND_TIMEOUT:
+    TIMEOUT: seconds after which a call gives up, including its retries
+    RETRIES: number of retries of calls that couldn't reach the backend or that it was too busy for,
+        after a random backoff of up to RETRY_BACKOFF seconds doubling with every retry
+    HEDGE_AFTER: seconds after which a second request is sent if the first one hasn't answered yet,
+        using the answer that comes first (0 to disable)
+    BREAKER_THRESHOLD: consecutive failures of a backend after which calls fail fast,
+        for BREAKER_COOLDOWN seconds
+Backends limit their own number of requests in flight (max_inflight) and answer 429 beyond, which is
+retried and otherwise reported as the backend being busy, instead of queueing up more work.
+"""
+import os
+import sys
+import time
+import random
+import pymongo
+import requests
+from requests.exceptions import HTTPError
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+_defaults = {'TIMEOUT': 300, 'RETRIES': 2, 'RETRY_BACKOFF': 1, 'HEDGE_AFTER': 0, 'BREAKER_THRESHOLD': 5, 'BREAKER_COOLDOWN': 30}
+_connect_timeout = 5
+# Answers that mean the backend couldn't handle the request, rather than that it couldn't analyse the audio
+_retried_status_codes = [429, 502, 503, 504]
+
+
+class BackendError(HTTPError):
+    pass
+
+
+class BackendClient:
+    def __init__(self, session, health_collection=None):
+        """
+        Args:
+            session (requests.Session): session making the requests
+            health_collection (callable): returns the collection keeping the circuit breaker state of
+                the backends, shared by all replicas, or None to disable circuit breaking
+        """
+        self.session = session
+        self.health_collection = health_collection
+
+    def get(self, backend, url, audio_path, params=None):
+        """Send the content of audio_path to a backend function and return its successful response"""
+        deadline = time.monotonic() + setting(backend, 'TIMEOUT')
+        health = self.health_collection() if self.health_collection else None
+        state = health.find_one({'_id': backend}) if health is not None else None
+        if state and state.get('open_until') and state['open_until'] > datetime.utcnow():
+            raise BackendError('"{}" is unavailable after repeated failures, try again in {:.0f} s'.format(
+                backend, (state['open_until'] - datetime.utcnow()).total_seconds()))
+
+        retries = int(setting(backend, 'RETRIES'))
+        for attempt in range(retries + 1):
+            try:
+                result = self._hedged_get(backend, url, audio_path, params, deadline)
+            except requests.exceptions.Timeout:
+                self._record_failure(health, backend)
+                raise BackendError('"{}" did not answer within {:g} s'.format(backend, setting(backend, 'TIMEOUT')))
+            except requests.exceptions.ConnectionError as e:
+                error = 'Could not reach "{}": {}'.format(backend, e)
+                if attempt == retries:
+                    self._record_failure(health, backend)
+            else:
+                if result.status_code == requests.codes.ok:
+                    if state and state.get('failures'):
+                        health.update_one({'_id': backend}, {'$set': {'failures': 0, 'open_until': None}})
+                    return result
+                if result.status_code == requests.codes.too_many_requests:
+                    error = '"{}" is busy, try again later'.format(backend)
+                else:
+                    error = '"{}" failed with status {}: {}'.format(backend, result.status_code, result.text.strip()[:200])
+                if result.status_code not in _retried_status_codes:
+                    raise BackendError(error)
+                if result.status_code != requests.codes.too_many_requests and attempt == retries:
+                    self._record_failure(health, backend)
+            backoff = random.uniform(0, setting(backend, 'RETRY_BACKOFF') * 2 ** attempt)
+            if attempt == retries or time.monotonic() + backoff >= deadline:
+                break
+            sys.stderr.write('{}, retrying in {:.1f} s\n'.format(error, backoff))
+            time.sleep(backoff)
+        raise BackendError(error)
+
+    def _hedged_get(self, backend, url, audio_path, params, deadline):
+        hedge_after = setting(backend, 'HEDGE_AFTER')
+        if not hedge_after or time.monotonic() + hedge_after >= deadline:
+            return self._get(url, audio_path, params, deadline)
+        pool = ThreadPoolExecutor(2)
+        try:
+            requests_in_flight = {pool.submit(self._get, url, audio_path, params, deadline)}
+            done, _ = wait(requests_in_flight, hedge_after)
+            if not done:
+                sys.stderr.write('No answer from "{}" after {} s, sending a hedged request\n'.format(backend, hedge_after))
+                requests_in_flight.add(pool.submit(self._get, url, audio_path, params, deadline))
+            while True:
+                done, requests_in_flight = wait(requests_in_flight, return_when=FIRST_COMPLETED)
+                request = done.pop()
+                if not requests_in_flight or (request.exception() is None and request.result().status_code == requests.codes.ok):
+                    for other in requests_in_flight:
+                        other.add_done_callback(lambda r: r.exception() is None and r.result().close())
+                    return request.result()
+        finally:
+            pool.shutdown(wait=False)
+
+    def _get(self, url, audio_path, params, deadline):
+        # Every request streams the audio from its own file handle
+        with open(audio_path, 'rb') as audio_content:
+            return self.session.get(url, data=audio_content, params=params, timeout=(_connect_timeout, max(deadline - time.monotonic(), 0.001)))
+
+    def _record_failure(self, health, backend):
+        if health is None:
+            return
+        state = health.find_one_and_update({'_id': backend}, {'$inc': {'failures': 1}}, upsert=True, return_document=pymongo.ReturnDocument.AFTER)
+        if state['failures'] >= setting(backend, 'BREAKER_THRESHOLD'):
+            health.update_one({'_id': backend}, {'$set': {'open_until': datetime.utcnow() + timedelta(seconds=setting(backend, 'BREAKER_COOLDOWN'))}})
+            sys.stderr.write('Failing fast for "{}" after {} consecutive failures\n'.format(backend, state['failures']))
+
+
+def setting(backend, name):
+    return float(os.getenv('{}_{}'.format(backend.upper().replace('-', '_'), name), os.getenv('BACKEND_' + name, _defaults[name])))
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""Bulk analysis of whole catalogues, to fill the descriptors collection in advance
+
+Reads ids of the form "content-provider:provider-id" from a file, one per line, and calculates the
+descriptors that are not in the DB yet. Only the first tab-separated field of a line is read, such
+that a failures file can be fed back in. The audio of an id is downloaded and decoded once, after
+which its calculations are queued per backend function, each with its own concurrency limit. The
+results of an id are written together with bulk writes, and only then is the position in the id
+file checkpointed, so a run that is interrupted resumes where it stopped. The lease of a descriptor is
+only taken when its calculation starts, and renewed until its result is written, so ids waiting in
+the queue of a backend don't keep other callers waiting. Descriptors that are being calculated
+elsewhere are left to the caller holding their lease.
+
+Runs next to the handler, with the same environment (MONGO_CONNECTION, GATEWAY_URL, ...):
+
+    python3 -m function.backfill jamendo-ids.txt --limit confident-chord-estimator=4 --limit sonic-annotator=8
+"""
+import os
+import sys
+import json
+import time
+import queue
+import signal
+import argparse
+import itertools
+import pymongo
+from datetime import datetime
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from . import handler
+
+
+class Backfill:
+    def __init__(self, req_descriptors, limits, num_downloads, window, batch_size, flush_interval, checkpoint_path, failures_path):
+        """
+        Args:
+            req_descriptors (list): descriptors to calculate, as stored in the DB
+            limits (dict): maximum number of concurrent calculations by backend function
+            num_downloads (int): maximum number of concurrent downloads
+            window (int): maximum number of ids being processed at once
+            batch_size (int): number of ids looked up and written per DB call
+            flush_interval (float): seconds after which finished ids are written even if the batch isn't full
+            checkpoint_path (str): file keeping the position in the id file
+            failures_path (str): file to which failed calculations are appended
+        """
+        self.descriptors = req_descriptors
+        self.window = window
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.checkpoint_path = checkpoint_path
+        self.failures = open(failures_path, 'a')
+        self.db = handler._get_db()
+        self.download_pool = ThreadPoolExecutor(num_downloads)
+        self.backend_pools = {b: ThreadPoolExecutor(limits[b]) for b in {handler.backend_functions[d] for d in req_descriptors}}
+        # Every backend call needs its own connection to the gateway
+        handler._session.mount(handler._gateway, HTTPAdapter(pool_maxsize=sum(limits[b] for b in self.backend_pools)))
+        self.events = queue.Queue()
+        # Downloads and calculations that haven't finished, to be cancelled when the run stops
+        self.pending = set()
+        self.tasks = {}
+        self.finished = []
+        self.done = set()
+        self.position = 0
+        self.counts = Counter()
+        self.backend_calls = Counter()
+        self.backend_time = defaultdict(float)
+        self.stopping = False
+        self.renewal_interval = handler._lease_duration.total_seconds() / 4
+
+    def run(self, ids_path, position=0, counts=None):
+        """Process the ids of a file from a position on, and return the counts of this run"""
+        self.position = position
+        previous_counts = Counter(counts or {})
+        ids = _read_ids(ids_path, position)
+        exhausted = False
+        start = last_flush = last_report = last_renewal = time.monotonic()
+        previous_handlers = {s: signal.signal(s, self._stop) for s in [signal.SIGINT, signal.SIGTERM]}
+        try:
+            while len(self.tasks) > len(self.finished) or not (exhausted or self.stopping):
+                if not (exhausted or self.stopping) and len(self.tasks) - len(self.finished) < self.window:
+                    chunk = list(itertools.islice(ids, self.batch_size))
+                    exhausted = len(chunk) < self.batch_size
+                    self._start(chunk)
+                    continue
+                try:
+                    self._handle(*self.events.get(timeout=1))
+                except queue.Empty:
+                    pass
+                now = time.monotonic()
+                if len(self.finished) >= self.batch_size or now - last_flush >= self.flush_interval:
+                    self._flush(ids_path, previous_counts)
+                    last_flush = now
+                if now - last_renewal >= self.renewal_interval:
+                    self._renew_leases()
+                    last_renewal = now
+                if now - last_report >= 60:
+                    self.report(now - start)
+                    last_report = now
+            self._flush(ids_path, previous_counts)
+        finally:
+            for s, previous_handler in previous_handlers.items():
+                signal.signal(s, previous_handler)
+            for future in list(self.pending):
+                future.cancel()
+            self.download_pool.shutdown(wait=False)
+            for pool in self.backend_pools.values():
+                pool.shutdown(wait=False)
+            self.failures.close()
+        self.report(time.monotonic() - start)
+        return self.counts
+
+    def report(self, duration):
+        sys.stderr.write('{} ids done in {:.0f} s ({:.2f} ids/s), up to line {}: {} descriptors stored ({:.2f}/s), {} found in DB, '
+                         '{} being calculated elsewhere, {} failed\n'.format(
+            self.counts['ids'], duration, self.counts['ids'] / max(duration, 1e-9), self.position, self.counts['stored'],
+            self.counts['stored'] / max(duration, 1e-9), self.counts['existing'], self.counts['busy'], self.counts['failed']))
+        for backend in sorted(self.backend_calls):
+            sys.stderr.write('  {}: {} calls, {:.1f} s on average\n'.format(
+                backend, self.backend_calls[backend], self.backend_time[backend] / self.backend_calls[backend]))
+
+    def _stop(self, signum, frame):
+        if self.stopping:
+            raise KeyboardInterrupt
+        sys.stderr.write('Finishing the {} ids in progress, interrupt again to abort\n'.format(len(self.tasks)))
+        self.stopping = True
+
+    def _start(self, chunk):
+        """Look up a chunk of ids in the DB and start processing those with missing descriptors"""
+        linked_ids = [linked_id for _, linked_id in chunk if linked_id]
+        found = {d: self._stored(linked_ids, d) for d in self.descriptors}
+        for position, linked_id in chunk:
+            missing = []
+            for descriptor in self.descriptors if linked_id else []:
+                if linked_id in found[descriptor]:
+                    self.counts['existing'] += 1
+                else:
+                    missing.append(descriptor)
+            if missing:
+                self.tasks[position] = {'id': linked_id, 'leases': {}, 'remaining': set(missing), 'fields': {}}
+                self._submit(self.download_pool, self._download, position, linked_id, missing)
+            else:
+                self._done(position)
+
+    def _submit(self, pool, function, *args):
+        future = pool.submit(function, *args)
+        self.pending.add(future)
+        future.add_done_callback(self.pending.discard)
+
+    def _stored(self, linked_ids, descriptor):
+        """The ids of which a descriptor is stored, without reading the descriptor itself"""
+        return {doc['_id'] for doc in self.db.descriptors.find({'_id': {'$in': linked_ids}, descriptor: {'$exists': True}}, {'_id': True})}
+
+    def _download(self, position, linked_id, missing):
+        try:
+            file_name, audio_path = handler._fetch_audio(linked_id)
+        except Exception as e:
+            self.events.put((position, None, 0, {}, {d: str(e) for d in missing}, {}, {}))
+            return
+        grouped = [d for d in missing if d in handler._sonic_annotator_outputs]
+        calculations = [grouped] if len(grouped) > 1 else []
+        calculations += [[d] for d in missing if not (len(grouped) > 1 and d in grouped)]
+        for descriptors in calculations:
+            self._submit(self.backend_pools[handler.backend_functions[descriptors[0]]], self._calculate,
+                         position, linked_id, file_name, audio_path, descriptors)
+
+    def _calculate(self, position, linked_id, file_name, audio_path, descriptors):
+        """Take the leases of descriptors of an id and calculate those that are still missing"""
+        leases, skipped = {}, {}
+        try:
+            for descriptor in descriptors:
+                lease_owner = handler._acquire_lease(linked_id, descriptor)
+                if lease_owner is None:
+                    skipped[descriptor] = 'busy'
+                # The descriptor might have been stored while the id was waiting for the backend
+                elif linked_id in self._stored([linked_id], descriptor):
+                    handler._release_lease(linked_id, descriptor, lease_owner)
+                    skipped[descriptor] = 'existing'
+                else:
+                    leases[descriptor] = lease_owner
+        except Exception as e:
+            self.events.put((position, None, 0, {}, {d: str(e) for d in descriptors if d not in skipped}, leases, skipped))
+            return
+        descriptors = list(leases)
+        if not descriptors:
+            self.events.put((position, None, 0, {}, {}, leases, skipped))
+            return
+        start = time.monotonic()
+        try:
+            if len(descriptors) > 1:
+                results = handler.calculate_sonic_annotator_descriptors(file_name, audio_path, descriptors)
+            else:
+                results = {descriptors[0]: handler.calculate_descriptor(file_name, audio_path, descriptors[0])}
+            errors = {d: 'Calculation of "{}" failed'.format(d) for d in descriptors if d not in results}
+        except Exception as e:
+            results, errors = {}, {d: str(e) for d in descriptors}
+        self.events.put((position, handler.backend_functions[descriptors[0]], time.monotonic() - start, results, errors, leases, skipped))
+
+    def _handle(self, position, backend, duration, results, errors, leases, skipped):
+        task = self.tasks[position]
+        task['leases'].update(leases)
+        if backend is not None:
+            self.backend_calls[backend] += 1
+            self.backend_time[backend] += duration
+        for descriptor, reason in skipped.items():
+            self.counts[reason] += 1
+        for descriptor, result_content in results.items():
+            try:
+                task['fields'].update(handler._descriptor_fields(task['id'], descriptor, result_content, self.db))
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                errors[descriptor] = 'Unexpected result: {}'.format(e)
+        for descriptor, error in errors.items():
+            self.failures.write('{}\t{}\t{}\n'.format(task['id'], descriptor, error.replace('\n', ' ')))
+            self.failures.flush()
+            self.counts['failed'] += 1
+            task['fields'].pop(descriptor, None)
+            if descriptor in task['leases']:
+                handler._release_lease(task['id'], descriptor, task['leases'].pop(descriptor))
+        task['remaining'].difference_update(results, errors, skipped)
+        if not task['remaining']:
+            self.finished.append(position)
+
+    def _flush(self, ids_path, previous_counts):
+        """Write the results of the finished ids and checkpoint"""
+        tasks = [self.tasks.pop(position) for position in self.finished]
+        updates = [pymongo.UpdateOne({'_id': t['id']}, {'$set': t['fields']}, upsert=True) for t in tasks if t['fields']]
+        if updates:
+            self.db.descriptors.bulk_write(updates, ordered=False)
+        for task in tasks:
+            for descriptor, lease_owner in task['leases'].items():
+                handler._release_lease(task['id'], descriptor, lease_owner)
+            self.counts['stored'] += len(task['leases'])
+        for position in self.finished:
+            self._done(position)
+        self.finished = []
+        counts = previous_counts + self.counts
+        _write_checkpoint(self.checkpoint_path, {'ids': os.path.abspath(ids_path), 'position': self.position, 'counts': dict(counts)})
+
+    def _renew_leases(self):
+        """Extend the leases of the calculations in progress, of which the results wait for the other descriptors of their id"""
+        owners = [lease_owner for task in self.tasks.values() for lease_owner in task['leases'].values()]
+        if owners:
+            self.db.leases.update_many({'owner': {'$in': owners}}, {'$set': {'expires': datetime.utcnow() + handler._lease_duration}})
+
+    def _done(self, position):
+        self.counts['ids'] += 1
+        self.done.add(position)
+        while self.position in self.done:
+            self.done.remove(self.position)
+            self.position += 1
+
+
+def _read_ids(path, start):
+    """Yield the line numbers and ids of a file from a line on, with an empty id for empty lines"""
+    with open(path) as f:
+        for position, line in enumerate(f):
+            if position >= start:
+                yield position, line.split('\t')[0].strip()
+
+
+def _write_checkpoint(path, checkpoint):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(path + '.tmp', path)
+
+
+def _limit(value):
+    backend, _, limit = value.partition('=')
+    if backend not in handler.backend_functions.values() or not limit.isdigit() or int(limit) < 1:
+        raise argparse.ArgumentTypeError('needs to be of the form BACKEND=N, with BACKEND one of {}'.format(
+            ', '.join(sorted(set(handler.backend_functions.values())))))
+    return backend, int(limit)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('ids', help='file with one id per line')
+    parser.add_argument('--descriptors', nargs='+', choices=handler.descriptors + ['essentia-music'],
+                        help='descriptors to calculate (default: all stored descriptors)')
+    parser.add_argument('--limit', type=_limit, action='append', default=[], metavar='BACKEND=N',
+                        help='maximum number of concurrent calculations of a backend function')
+    parser.add_argument('--default-limit', type=int, default=2, help='concurrency limit of the other backend functions')
+    parser.add_argument('--downloads', type=int, default=handler._batch_workers, help='maximum number of concurrent downloads')
+    parser.add_argument('--window', type=int, help='maximum number of ids in progress (default: twice the total concurrency)')
+    parser.add_argument('--batch-size', type=int, default=100, help='number of ids per DB lookup and bulk write')
+    parser.add_argument('--flush-interval', type=float, default=10, help='maximum seconds between bulk writes')
+    parser.add_argument('--checkpoint', help='checkpoint file (default: IDS.checkpoint)')
+    parser.add_argument('--failures', help='file to append failed calculations to (default: IDS.failures)')
+    parser.add_argument('--restart', action='store_true', help='ignore an existing checkpoint and start from the first id')
+    args = parser.parse_args()
+    if not os.path.isfile(args.ids):
+        parser.error('No such file "{}"'.format(args.ids))
+
+    req_descriptors = list(dict.fromkeys(map(handler._requested_descriptor, args.descriptors or handler.backend_functions)))
+    limits = defaultdict(lambda: args.default_limit, args.limit)
+    checkpoint_path = args.checkpoint or args.ids + '.checkpoint'
+    checkpoint = {'position': 0, 'counts': {}}
+    if os.path.exists(checkpoint_path) and not args.restart:
+        with open(checkpoint_path) as f:
+            checkpoint = json.load(f)
+        if checkpoint['ids'] != os.path.abspath(args.ids):
+            parser.error('Checkpoint "{}" belongs to "{}", use --checkpoint or --restart'.format(checkpoint_path, checkpoint['ids']))
+        sys.stderr.write('Resuming from line {}\n'.format(checkpoint['position']))
+    window = args.window or 2 * (args.downloads + sum(limits[b] for b in {handler.backend_functions[d] for d in req_descriptors}))
+
+    backfill = Backfill(req_descriptors, limits, args.downloads, window, args.batch_size, args.flush_interval,
+                        checkpoint_path, args.failures or args.ids + '.failures')
+    counts = backfill.run(args.ids, checkpoint['position'], checkpoint['counts'])
+    sys.exit(1 if counts['failed'] else 0)
@@ -0,0 +1,131 @@
+"""Decode-once stage that caches the audio sent to the backends, optionally as 44.1 kHz mono 16-bit audio
+
+Audio is cached on local disk under the hash of the original content, which is hashed while streamed
+audio is written to disk, such that the audio of an id or upload is only downloaded and written once.
+
+CANONICAL_FORMAT chooses what is sent to the backends:
+- original (default): the original file, which every backend decodes for itself, as it always has.
+- flac: the audio decoded once by ffmpeg, downmixed and resampled to 44.1 kHz mono. It is several
+  times the size of the usual MP3 or Ogg file, and the backends still decode it, if more cheaply.
+- wav: as flac, but about twice the size, and read by the backends without decoding (madmom even
+  memory maps it).
+The backends then analyse audio downmixed and resampled by ffmpeg instead of by their own decoders,
+which slightly changes the calculated values. Only switch to flac or wav with an empty descriptors
+collection, or after removing the stored descriptors, such that all results come from the same input.
+"""
+import os
+import sys
+import time
+import uuid
+import hashlib
+import subprocess
+from . import timing
+
+
+cache_dir = os.getenv('PCM_CACHE_DIR', '/tmp/pcm')
+cache_size = int(os.getenv('PCM_CACHE_SIZE', 2*1024**3))
+# Files that might still be read by an ongoing calculation are never evicted
+_min_age = float(os.getenv('PCM_CACHE_MIN_AGE', 600))
+_chunk_size = 1024*1024
+_format = os.getenv('CANONICAL_FORMAT', 'original')
+_codecs = {'flac': 'flac', 'wav': 'pcm_s16le'}
+
+
+def decode(file_name, audio_content, digest=None):
+    """Return the file name and the path of the canonical version of some audio
+
+    When ffmpeg can't transcode the audio into the canonical format, the original content is passed on
+    instead, such that the extractors can still try their own decoders.
+
+    Args:
+        file_name (str): name of the audio file
+        audio_content (bytes or file): the audio, or a stream of it that is copied to disk in chunks
+        digest (str): optional SHA-256 hex digest of audio_content in bytes, when already known
+    """
+    extension = os.path.splitext(file_name)[1]
+    os.makedirs(cache_dir, exist_ok=True)
+    if isinstance(audio_content, bytes):
+        digest = digest or hashlib.sha256(audio_content).hexdigest()
+        cached = _cached(digest, file_name, extension)
+        if cached is not None:
+            return cached
+        input_path = os.path.join(cache_dir, '{}.{}{}'.format(digest, uuid.uuid4().hex, extension))
+        with open(input_path, 'wb') as f:
+            f.write(audio_content)
+    else:
+        input_path = os.path.join(cache_dir, '{}{}'.format(uuid.uuid4().hex, extension))
+        sha256 = hashlib.sha256()
+        try:
+            with open(input_path, 'wb') as f, timing.stage('download'):
+                for chunk in iter(lambda: audio_content.read(_chunk_size), b''):
+                    sha256.update(chunk)
+                    f.write(chunk)
+        except BaseException:
+            os.remove(input_path)
+            raise
+        digest = sha256.hexdigest()
+        cached = _cached(digest, file_name, extension)
+        if cached is not None:
+            os.remove(input_path)
+            return cached
+    path = _transcode(file_name, input_path, digest) if _format in _codecs else None
+    if path is not None:
+        file_name = os.path.splitext(file_name)[0] + '.' + _format
+    else:
+        path = os.path.join(cache_dir, digest + '.orig' + extension)
+        os.replace(input_path, path)
+    _evict(path)
+    return file_name, path
+
+
+def _transcode(file_name, input_path, digest):
+    """Transcode a file into the canonical format and return the path of the result, or None when ffmpeg can't decode it"""
+    output_path = input_path + '.' + _format
+    try:
+        with timing.stage('decode'):
+            subprocess.run(['ffmpeg', '-v', 'error', '-nostdin', '-i', input_path, '-ac', '1', '-ar', '44100',
+                            '-sample_fmt', 's16', '-c:a', _codecs[_format], '-f', _format, output_path],
+                           stderr=subprocess.PIPE, check=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        sys.stderr.write('Could not decode "{}", passing it on as is: {}\n'.format(
+            file_name, e.stderr.decode(errors='replace').strip() if isinstance(e, subprocess.CalledProcessError) else e))
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        return None
+    path = os.path.join(cache_dir, digest + '.' + _format)
+    os.replace(output_path, path)
+    os.remove(input_path)
+    return path
+
+
+def _cached(digest, file_name, extension):
+    for path, name in [(os.path.join(cache_dir, digest + '.' + _format), os.path.splitext(file_name)[0] + '.' + _format),
+                       (os.path.join(cache_dir, digest + '.orig' + extension), file_name)]:
+        if os.path.exists(path):
+            os.utime(path)
+            timing.count('pcm-cache', True)
+            return name, path
+    timing.count('pcm-cache', False)
+    return None
+
+
+def _evict(keep):
+    """Remove the least recently used files except keep, until the cache fits in its size"""
+    files = []
+    for entry in os.scandir(cache_dir):
+        try:
+            files.append((entry.stat().st_mtime, entry.stat().st_size, entry.path))
+        except FileNotFoundError:
+            pass
+    total_size = sum(size for _, size, _ in files)
+    now = time.time()
+    for mtime, size, path in sorted(files):
+        if total_size <= cache_size or now - mtime < _min_age:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+            total_size -= size
+        except FileNotFoundError:
+            pass
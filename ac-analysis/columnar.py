@@ -0,0 +1,69 @@
+"""Columnar representation of time series descriptors
+
+Lists of objects such as the chord sequence become parallel arrays, with float32 times and labels
+coded into a dictionary, which are encoded as compact JSON, msgpack or a NumPy .npz archive. E.g. for
+the chords:
+
+    {"chords": {"confidence": 0.8, "duration": 10.0, "chordSequence": {
+        "start": [0.0, 4.1], "end": [4.1, 10.0],
+        "label": {"dictionary": ["Amin", "Cmaj"], "codes": [1, 0]}}}, "id": "..."}
+
+In msgpack all floats are single precision, in an .npz archive nested keys are joined by dots.
+"""
+import io
+import json
+import numpy as np
+import msgpack
+
+
+content_types = ['application/vnd.ac.columnar+json', 'application/x-msgpack', 'application/x-npz']
+
+
+def to_columns(descriptor, response):
+    """Replace the list of objects in a rewritten descriptor output by columns"""
+    response = dict(response)
+    if descriptor == 'chords':
+        response['chords'] = dict(response['chords'])
+        response['chords']['chordSequence'] = _columns(response['chords']['chordSequence'], ['start', 'end'], ['label'])
+    elif descriptor == 'keys':
+        response['keys'] = _columns(response['keys'], ['time'], ['label'])
+    elif descriptor == 'beats':
+        response['beats'] = np.array(response['beats'], dtype=np.float32)
+    return response
+
+
+def encode(response, content_type):
+    if content_type == 'application/vnd.ac.columnar+json':
+        return json.dumps(response, default=_json_array, separators=(',', ':'))
+    elif content_type == 'application/x-msgpack':
+        return msgpack.packb(response, default=lambda a: a.tolist(), use_single_float=True)
+    elif content_type == 'application/x-npz':
+        f = io.BytesIO()
+        np.savez_compressed(f, **_flatten(response))
+        return f.getvalue()
+
+
+def _columns(objects, time_fields, label_fields):
+    columns = {field: np.array([o[field] for o in objects], dtype=np.float32) for field in time_fields}
+    for field in label_fields:
+        dictionary, codes = np.unique(np.array([o[field] for o in objects], dtype=str), return_inverse=True)
+        columns[field] = {'dictionary': dictionary.tolist(),
+                          'codes': codes.astype(np.min_scalar_type(max(len(dictionary) - 1, 0)))}
+    return columns
+
+
+def _json_array(a):
+    if a.dtype == np.float32:
+        # The shortest representation that reads back as the same float32
+        return [float(x) for x in a.astype(str)]
+    return a.tolist()
+
+
+def _flatten(response, prefix=''):
+    arrays = {}
+    for k, v in response.items():
+        if isinstance(v, dict):
+            arrays.update(_flatten(v, prefix + k + '.'))
+        else:
+            arrays[prefix + k] = np.asarray(v)
+    return arrays
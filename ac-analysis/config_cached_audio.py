@@ -1,40 +1,154 @@
 import requests
 import os
 import minio
-import io
+import urllib3
+from minio.error import S3Error, MinioException
 import os.path
 import urllib.parse
 import cgi
 import mimetypes
+import threading
+import contextlib
+from collections import OrderedDict
 from datetime import timedelta
 from .config_direct_audio import providers, audio_uri as provider_uri
+from . import timing
 
 
 _client = minio.Minio(os.getenv('MINIO_HOSTNAME'), access_key=os.getenv('MINIO_ACCESS_KEY'), secret_key=os.getenv('MINIO_SECRET_KEY'), secure=False)
+_part_size = int(os.getenv('MINIO_PART_SIZE', 10*1024*1024))
+# Names of the cached objects of ids, in front of the audio_objects collection that replaces listing the buckets
+_index_size = int(os.getenv('OBJECT_INDEX_SIZE', 10000))
+_object_names = OrderedDict()
+_index_lock = threading.Lock()
 
 
 def audio_uri(provider_id, provider):
+    with _storage_errors(provider_id, provider):
+        object_name = _object_name(provider_id, provider) or _cache_object(provider_id, provider)
+        return _client.presigned_get_object(provider, object_name, expires=timedelta(minutes=3))
+
+
+@contextlib.contextmanager
+def open_audio(provider_id, provider):
+    """Stream the cached audio of an id from MinIO, caching it first when needed
+
+    Yields the file name of the audio and a stream of its content. Errors of MinIO, also while reading
+    the stream, are raised as RequestException.
+    """
+    with _storage_errors(provider_id, provider):
+        object_name = _object_name(provider_id, provider) or _cache_object(provider_id, provider)
+        try:
+            response = _client.get_object(provider, object_name)
+        except S3Error as e:
+            if e.code not in ['NoSuchKey', 'NoSuchBucket']:
+                raise
+            # The object was removed since it was indexed
+            _forget(provider_id, provider)
+            object_name = _cache_object(provider_id, provider)
+            response = _client.get_object(provider, object_name)
+    try:
+        with _storage_errors(provider_id, provider):
+            yield os.path.basename(object_name), response
+    finally:
+        response.close()
+        response.release_conn()
+
+
+@contextlib.contextmanager
+def _storage_errors(provider_id, provider):
+    """Raise the errors of MinIO and of its connections like those of the providers, which callers handle"""
+    try:
+        yield
+    except (MinioException, urllib3.exceptions.HTTPError) as e:
+        raise requests.exceptions.RequestException('Could not get the audio of "{}:{}" from the cache: {}'.format(
+            provider, provider_id, e)) from e
+
+
+def _object_prefix(provider_id, provider):
     if provider in ['jamendo-tracks', 'freesound-sounds']:
-        object_prefix = provider_id[-2:] + '/' + provider_id
+        return provider_id[-2:] + '/' + provider_id
+    return provider_id
+
+
+def _object_name(provider_id, provider):
+    """Name of the cached object of an id, or None when it isn't cached yet"""
+    linked_id = provider + ':' + provider_id
+    with _index_lock:
+        if linked_id in _object_names:
+            _object_names.move_to_end(linked_id)
+            return _object_names[linked_id]
+    with timing.stage('object-index'):
+        indexed = _index().find_one({'_id': linked_id})
+    if indexed is not None:
+        object_name = indexed['object']
     else:
-        object_prefix = provider_id
-    try:
-        object_name = next(_client.list_objects(provider, prefix=object_prefix)).object_name
-    except (StopIteration, minio.error.NoSuchBucket):
-        url = provider_uri(provider_id, provider)
-        r = requests.get(url)
-        r.raise_for_status()
+        # Objects cached before the index existed are found by listing, and indexed from then on
         try:
-            _, params = cgi.parse_header(r.headers['Content-Disposition'])
-            file_ext = os.path.splitext(params['filename'])[1]
-            # TODO add handling of filename*
-        except KeyError:
-            file_ext = os.path.splitext(urllib.parse.urlparse(url).path)[1]
-            if not file_ext:
-                try:
-                    file_ext = mimetypes.guess_extension(r.headers['Content-Type'])
-                except KeyError:
-                    pass
-        object_name = object_prefix+file_ext
-        _client.put_object(provider, object_name, io.BytesIO(r.content), int(r.headers['Content-Length']), r.headers['Content-Type'])
-    return _client.presigned_get_object(provider, object_name, expires=timedelta(minutes=3))
+            with timing.stage('minio-list'):
+                object_name = next(_client.list_objects(provider, prefix=_object_prefix(provider_id, provider))).object_name
+        except (StopIteration, S3Error) as e:
+            if isinstance(e, S3Error) and e.code != 'NoSuchBucket':
+                raise
+            return None
+        _index_object(linked_id, object_name)
+    _remember(linked_id, object_name)
+    return object_name
+
+
+def _cache_object(provider_id, provider):
+    """Copy the audio of an id from its provider to MinIO and return the name of the object"""
+    with timing.stage('provider'):
+        url = provider_uri(provider_id, provider)
+    r = requests.get(url, stream=True)
+    r.raise_for_status()
+    try:
+        _, params = cgi.parse_header(r.headers['Content-Disposition'])
+        file_ext = os.path.splitext(params['filename'])[1]
+        # TODO add handling of filename*
+    except KeyError:
+        file_ext = os.path.splitext(urllib.parse.urlparse(url).path)[1]
+        if not file_ext:
+            try:
+                file_ext = mimetypes.guess_extension(r.headers['Content-Type'])
+            except KeyError:
+                pass
+    object_name = _object_prefix(provider_id, provider)+(file_ext or '')
+    # Stream the download into a multipart upload, such that at most one part is held in memory
+    if 'Content-Length' in r.headers and 'Content-Encoding' not in r.headers:
+        length = int(r.headers['Content-Length'])
+    else:
+        length = -1
+    r.raw.decode_content = True
+    with r, timing.stage('minio-upload'):
+        _client.put_object(provider, object_name, r.raw, length, r.headers.get('Content-Type', 'application/octet-stream'), part_size=_part_size)
+    linked_id = provider + ':' + provider_id
+    _index_object(linked_id, object_name)
+    _remember(linked_id, object_name)
+    return object_name
+
+
+def _index():
+    # The connection of the handler, imported here as the handler imports this module
+    from .handler import _get_db
+    return _get_db().audio_objects
+
+
+def _index_object(linked_id, object_name):
+    with timing.stage('object-index'):
+        _index().update_one({'_id': linked_id}, {'$set': {'object': object_name}}, upsert=True)
+
+
+def _remember(linked_id, object_name):
+    with _index_lock:
+        _object_names[linked_id] = object_name
+        _object_names.move_to_end(linked_id)
+        while len(_object_names) > _index_size:
+            _object_names.popitem(last=False)
+
+
+def _forget(provider_id, provider):
+    linked_id = provider + ':' + provider_id
+    with _index_lock:
+        _object_names.pop(linked_id, None)
+    _index().delete_one({'_id': linked_id})
@@ -3,41 +3,94 @@ import sys
 import json
 import pymongo
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import HTTPError
 import os.path
+import time
+import uuid
+import threading
+import hashlib
+import contextlib
+from datetime import datetime, timedelta
 from urllib.parse import parse_qsl, urlsplit
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from .config import providers, audio_uri
+try:
+    from .config import open_audio
+except ImportError:
+    open_audio = None
 from . import ld_converter
+from . import columnar
+from . import canonical_audio
+from . import stored_format
+from . import jobs
+from . import timing
+from .response_cache import ResponseCache, etag_matches
+from .backends import BackendClient
+from .search_fields import search_fields, provider_field
 
 
 descriptors = ['chords', 'instruments', 'beats-beatroot', 'keys', 'tempo', 'global-key', 'tuning', 'beats']
 # Candidate content-types: 'text/plain', 'text/n3', 'application/rdf+xml'
-supported_output = {'chords': ['application/json', 'application/ld+json'],
+supported_output = {'chords': ['application/json', 'application/ld+json'] + columnar.content_types,
                     'instruments': ['application/json'],
                     'beats-beatroot': ['application/json', 'application/ld+json'],
-                    'keys': ['application/json'],
+                    'keys': ['application/json'] + columnar.content_types,
                     'tempo': ['application/json'],
                     'global-key': ['application/json'],
                     'tuning': ['application/json'],
-                    'beats': ['application/json'],
+                    'beats': ['application/json'] + columnar.content_types,
                     } # default output first
+# Backend function calculating each stored descriptor
+backend_functions = {'chords': 'confident-chord-estimator', 'essentia-music': 'essentia', 'instruments': 'instrument-identifier',
+                     'keys': 'sonic-annotator', 'beats-beatroot': 'sonic-annotator'}
+# Vamp plugin and output of the sonic-annotator transform of a descriptor, to split combined outputs
+_sonic_annotator_outputs = {'keys': ('qm-keydetector', 'key'), 'beats-beatroot': ('beatroot', 'beats')}
+_gateway = os.getenv('GATEWAY_URL', 'http://gateway:8080')
+_batch_workers = int(os.getenv('BATCH_WORKERS', 8))
+_lease_duration = timedelta(seconds=float(os.getenv('LEASE_DURATION', 360)))
+_lease_poll_interval = float(os.getenv('LEASE_POLL_INTERVAL', 2))
+# Long-polling a job needs to return before the gateway times out
+_max_job_wait = float(os.getenv('JOB_MAX_WAIT', 60))
+_shared_response_cache = os.getenv('RESPONSE_CACHE_SHARED', 'false') == 'true'
+_response_cache = ResponseCache(int(os.getenv('RESPONSE_CACHE_SIZE', 64*1024*1024)), float(os.getenv('RESPONSE_CACHE_TTL', 300)),
+                                (lambda: _get_db().rendered_responses) if _shared_response_cache else None)
+_metrics = os.getenv('METRICS', 'true') == 'true'
 _client = None
+_init_lock = threading.Lock()
+# Keep-alive connections to the gateway and the audio sources, shared by all threads
+_session = requests.Session()
+_session.mount('http://', HTTPAdapter(pool_maxsize=max(10, 2*_batch_workers)))
+_session.mount('https://', HTTPAdapter(pool_maxsize=max(10, _batch_workers)))
+_backends = BackendClient(_session, lambda: _get_db().backend_health)
+# Watchdog variables of the request being handled (Http_Path, Http_Query, ...), set per thread by the
+# long-lived server, or in the process environment by the classic watchdog
+_request = threading.local()
 _instrument_names = ['Shaker', 'Electronic Beats', 'Drum Kit', 'Synthesizer', 'Female Voice', 'Male Voice', 'Violin', 'Flute', 'Harpsichord', 'Electric Guitar', 'Clarinet', 'Choir', 'Organ', 'Acoustic Guitar', 'Viola', 'French Horn', 'Piano', 'Cello', 'Harp', 'Conga', 'Synthetic Bass', 'Electric Piano', 'Acoustic Bass', 'Electric Bass']
 
 
 def handle(audio_content):
     """handle a request to the function
     """
+    timing.start()
     try:
-        descriptor = os.getenv('Http_Path', '').lstrip('/')
+        descriptor = _request_var('Http_Path', '').lstrip('/')
         if descriptor == 'providers':
             return json.dumps(providers)
         elif descriptor == 'descriptors':
             return json.dumps(descriptors)
+        elif descriptor == 'batch':
+            return json.dumps(handle_batch(audio_content))
+        elif descriptor == 'jobs':
+            return json.dumps(handle_job())
+        elif descriptor == 'metrics':
+            _set_response_header('Content-Type', 'text/plain; version=0.0.4')
+            return timing.render(timing.totals(_get_db().metrics, 'ac-analysis'), 'ac_analysis')
         elif descriptor not in descriptors:
             raise HTTPError('Unknown descriptor "{}". Allowed descriptors are : {}'.format(descriptor, descriptors))
 
-        content_type = os.getenv('Http_Content_Type')
+        content_type = _request_var('Http_Content_Type')
         if content_type:
             if content_type not in supported_output[descriptor]:
                 raise HTTPError('Only {} content-type{} are supported for the "{}" descriptor'.format(
@@ -47,26 +100,170 @@ def handle(audio_content):
         else:
             content_type = supported_output[descriptor][0]
 
-        query = dict(parse_qsl(os.getenv('Http_Query')))
+        query = dict(parse_qsl(_request_var('Http_Query', '')))
 
-        req_descriptor = 'essentia-music' if descriptor in ['tempo', 'global-key', 'tuning', 'beats'] else descriptor
+        req_descriptor = _requested_descriptor(descriptor)
         if audio_content:
             file_id = query.get('id', 'undefined')
-            response = calculate_descriptor(file_id, audio_content, req_descriptor)
+            digest = hashlib.sha256(audio_content).hexdigest()
+            response = get_descriptor(content_id(digest), req_descriptor, (file_id, audio_content, digest))
+            _set_response_header('Content-Type', content_type)
+            return render_response(descriptor, response, file_id, content_type)
         elif 'id' in query:
             file_id = query['id']
-            response = get_descriptor(file_id, req_descriptor)
+            cached = _response_cache.get((file_id, descriptor, content_type))
+            timing.count('response-cache', cached is not None)
+            if cached is None and query.get('async') == 'true' and not _get_db().descriptors.count_documents(
+                    {'_id': file_id, req_descriptor: {'$exists': True}}, limit=1):
+                job, dispatch = jobs.submit(_get_db(), file_id, req_descriptor)
+                if dispatch:
+                    _dispatch_job(job)
+                return json.dumps(jobs.to_response(job))
+            _set_response_header('Content-Type', content_type)
+            if cached is not None:
+                rendered, etag = cached
+            else:
+                rendered = render_response(descriptor, get_descriptor(file_id, req_descriptor), file_id, content_type)
+                etag = _response_cache.put((file_id, descriptor, content_type), rendered)
+            _set_response_header('ETag', etag)
+            if etag_matches(_request_var('Http_If_None_Match'), etag) and _set_response_status(304):
+                return ''
+            return rendered
         else:
             raise HTTPError('Nothing to do')
-        response = rewrite_descriptor_output(descriptor, response)
-        response['id'] = file_id
-        
-        if content_type == 'application/json':
-            return json.dumps(response)
-        elif content_type == 'application/ld+json':
-            return json.dumps(ld_converter.convert(descriptor, response, 'json-ld'))
     except HTTPError as e:
         return json.dumps(str(e))
+    finally:
+        server_timing = timing.finish('ac-analysis', (lambda: _get_db().metrics) if _metrics else None)
+        if server_timing:
+            _set_response_header('Server-Timing', server_timing)
+
+
+def _request_var(name, default=None):
+    return getattr(_request, 'environ', os.environ).get(name, default)
+
+
+def _set_response_header(name, value):
+    # The classic watchdog can't set headers, only the long-lived server can
+    if hasattr(_request, 'headers'):
+        _request.headers[name] = value
+
+
+def _set_response_status(status):
+    """Set the status code of the response, returning whether that is possible"""
+    if not hasattr(_request, 'status'):
+        return False
+    _request.status = status
+    return True
+
+
+def warm_up():
+    """Connect to the DB before the long-lived server takes requests"""
+    _get_db()
+
+
+def render_response(descriptor, response, file_id, content_type):
+    with timing.stage('rewrite'):
+        response = rewrite_descriptor_output(descriptor, response)
+    response['id'] = file_id
+    if content_type == 'application/ld+json':
+        # The chords are converted from their result, not from the object wrapping it
+        if descriptor == 'chords':
+            response = dict(response['chords'], id=file_id)
+        with timing.stage('ld-conversion'):
+            response = ld_converter.convert(descriptor, response, 'json-ld')
+    with timing.stage('serialization'):
+        if content_type in columnar.content_types:
+            return columnar.encode(columnar.to_columns(descriptor, response), content_type)
+        return json.dumps(response)
+
+
+def handle_batch(batch_content):
+    """handle a request for many ids and descriptors at once
+    Args:
+        batch_content (bytes): optional JSON object with "ids" and "descriptors" lists,
+            taking precedence over the comma-separated "ids" and "descriptors" query parameters
+    Returns a list with an object per id, holding the output of every descriptor under its name,
+    and the error of every failed descriptor under "errors".
+    """
+    content_type = _request_var('Http_Content_Type')
+    if content_type and content_type != 'application/json':
+        raise HTTPError('Only "application/json" content-type is supported for batch requests')
+    if batch_content:
+        try:
+            batch = json.loads(batch_content)
+            linked_ids, batch_descriptors = batch['ids'], batch['descriptors']
+        except (ValueError, KeyError, TypeError):
+            raise HTTPError('Batch requests need a JSON body of the form {"ids": [...], "descriptors": [...]}')
+    else:
+        query = dict(parse_qsl(_request_var('Http_Query', '')))
+        linked_ids = [i for i in query.get('ids', '').split(',') if i]
+        batch_descriptors = [d for d in query.get('descriptors', '').split(',') if d]
+    if not linked_ids or not batch_descriptors:
+        raise HTTPError('Nothing to do')
+    unknown_descriptors = [d for d in batch_descriptors if d not in descriptors]
+    if unknown_descriptors:
+        raise HTTPError('Unknown descriptor{} "{}". Allowed descriptors are : {}'.format(
+            's' if len(unknown_descriptors) > 1 else '', '", "'.join(unknown_descriptors), descriptors))
+    linked_ids = list(dict.fromkeys(linked_ids))
+    batch_descriptors = list(dict.fromkeys(batch_descriptors))
+
+    results, errors = get_descriptors(linked_ids, set(map(_requested_descriptor, batch_descriptors)))
+    response = []
+    for linked_id in linked_ids:
+        item = {'id': linked_id}
+        for descriptor in batch_descriptors:
+            req_descriptor = _requested_descriptor(descriptor)
+            if (linked_id, req_descriptor) in results:
+                output = rewrite_descriptor_output(descriptor, results[(linked_id, req_descriptor)])
+                # The JAMS document of beats-beatroot is the only output not wrapped in an object keyed by its descriptor
+                item[descriptor] = output if descriptor == 'beats-beatroot' else output[descriptor]
+            else:
+                item.setdefault('errors', {})[descriptor] = errors.get((linked_id, req_descriptor), 'Calculation of "{}" failed'.format(descriptor))
+        response.append(item)
+    return response
+
+
+def handle_job():
+    """handle a request for a job of an asynchronous request
+
+    A POST runs the job if it is still queued, as done by asynchronous invocations. Otherwise the job
+    is returned, after waiting for it to finish for at most the number of seconds in the "wait" query parameter.
+    """
+    query = dict(parse_qsl(_request_var('Http_Query', '')))
+    if 'job' not in query:
+        raise HTTPError('Nothing to do')
+    if _request_var('Http_Method') == 'POST':
+        job = run_job(query['job'])
+        if job is not None:
+            return jobs.to_response(job)
+    try:
+        timeout = min(float(query.get('wait', 0)), _max_job_wait)
+    except ValueError:
+        raise HTTPError('"wait" needs to be a number of seconds')
+    job = jobs.wait(_get_db(), query['job'], timeout, _lease_poll_interval)
+    if job is None:
+        raise HTTPError('Unknown job "{}"'.format(query['job']))
+    return jobs.to_response(job)
+
+
+def run_job(job_id=None):
+    """Claim a queued job, or the oldest one without job_id, and calculate its descriptor
+
+    Returns the finished job, or None when there was nothing to run.
+    """
+    db = _get_db()
+    job = jobs.claim(db, _lease_duration, job_id)
+    if job is None:
+        return None
+    sys.stderr.write('Running job {} for "{}" of "{}"\n'.format(job['_id'], job['descriptor'], job['id']))
+    try:
+        get_descriptor(job['id'], job['descriptor'])
+    # Any failure is recorded, rather than leaving the job running until its lease expires
+    except Exception as e:
+        sys.stderr.write('Job {} failed: {!r}\n'.format(job['_id'], e))
+        return jobs.complete(db, job, str(e) or repr(e))
+    return jobs.complete(db, job)
 
 
 def rewrite_descriptor_output(descriptor, response):
@@ -90,52 +287,380 @@ def rewrite_descriptor_output(descriptor, response):
     return response
 
 
-def get_descriptor(linked_id, descriptor):
+def get_descriptor(linked_id, descriptor, audio=None):
+    """Retrieve a descriptor from the DB, or calculate and store it
+
+    A sonic-annotator descriptor is calculated and stored together with the other sonic-annotator
+    descriptors missing for the id, in a single call.
+
+    Args:
+        linked_id (str): id of the form "content-provider:provider-id", or a content id
+        descriptor (str): descriptor as stored in the DB
+        audio (tuple): optional (file_name, audio_content, digest) to calculate the descriptor from, instead of downloading it,
+            with the SHA-256 hex digest of audio_content
+    """
     db = _get_db()
-    result = db.descriptors.find_one({'_id': linked_id, descriptor: {'$exists': True}})
-    if result is not None:
-        sys.stderr.write('Result found in DB\n')
-        return result[descriptor]
+    while True:
+        with timing.stage('db'):
+            result = db.descriptors.find_one({'_id': linked_id, descriptor: {'$exists': True}}, {descriptor: True})
+            timing.count('db', result is not None)
+            if result is not None:
+                sys.stderr.write('Result found in DB\n')
+                return stored_format.decode(result[descriptor], db)
+        lease_owner = _acquire_lease(linked_id, descriptor)
+        if lease_owner is not None:
+            # The previous holder might have stored the descriptor and released its lease since
+            result = db.descriptors.find_one({'_id': linked_id, descriptor: {'$exists': True}}, {descriptor: True})
+            if result is not None:
+                _release_lease(linked_id, descriptor, lease_owner)
+                return stored_format.decode(result[descriptor], db)
+            break
+        result_content = _wait_for_descriptor(linked_id, descriptor)
+        if result_content is not None:
+            return result_content
 
+    # The other sonic-annotator descriptors missing for the id are calculated in the same call
+    grouped = _grouped_leases(linked_id, descriptor) if descriptor in _sonic_annotator_outputs else {}
+    try:
+        file_name, audio_path = canonical_audio.decode(*audio) if audio is not None else _fetch_audio(linked_id)
+        if grouped:
+            results = calculate_sonic_annotator_descriptors(file_name, audio_path, [descriptor] + list(grouped))
+            for other in [d for d in grouped if d in results]:
+                _store_descriptor(linked_id, other, results[other])
+            if descriptor not in results:
+                raise HTTPError('Calculation of "{}" failed'.format(descriptor))
+            result_content = results[descriptor]
+        else:
+            result_content = calculate_descriptor(file_name, audio_path, descriptor)
+        _store_descriptor(linked_id, descriptor, result_content)
+    finally:
+        _release_lease(linked_id, descriptor, lease_owner)
+        for other, other_owner in grouped.items():
+            _release_lease(linked_id, other, other_owner)
+    return result_content
+
+
+def get_descriptors(linked_ids, req_descriptors):
+    """Retrieve or calculate several descriptors for several ids at once
+
+    All ids are looked up in the DB with a single query. The audio of every id with missing
+    descriptors is downloaded and decoded once and the missing descriptors are calculated in parallel,
+    with a single sonic-annotator call for all its descriptors of an id.
+    Descriptors that are already being calculated elsewhere are waited for instead. The leases of the
+    missing descriptors are renewed until the batch is done.
+    Returns a dict of results and a dict of error messages, both keyed by (id, descriptor).
+    """
+    db = _get_db()
+    with timing.stage('db'):
+        found = {doc['_id']: doc for doc in db.descriptors.find({'_id': {'$in': linked_ids}}, {d: True for d in req_descriptors})}
+    results = {}
+    missing = defaultdict(dict)
+    awaited = []
+    for linked_id in linked_ids:
+        for descriptor in req_descriptors:
+            if descriptor in found.get(linked_id, {}):
+                results[(linked_id, descriptor)] = stored_format.decode(found[linked_id][descriptor], db)
+            else:
+                lease_owner = _acquire_lease(linked_id, descriptor)
+                if lease_owner is not None:
+                    missing[linked_id][descriptor] = lease_owner
+                else:
+                    awaited.append((linked_id, descriptor))
+    if missing:
+        # The previous holders of the leases might have stored their descriptors and released them since
+        for doc in db.descriptors.find({'_id': {'$in': list(missing)}}, {d: True for d in req_descriptors}):
+            for descriptor in [d for d in missing[doc['_id']] if d in doc]:
+                results[(doc['_id'], descriptor)] = stored_format.decode(doc[descriptor], db)
+                _release_lease(doc['_id'], descriptor, missing[doc['_id']].pop(descriptor))
+        missing = {linked_id: leases for linked_id, leases in missing.items() if leases}
+    sys.stderr.write('{} results found in DB, {} ids with missing descriptors, {} descriptors being calculated elsewhere\n'.format(
+        len(results), len(missing), len(awaited)))
+
+    errors = {}
+    # Ids waiting for a download or calculation worker would otherwise outlive their leases
+    with _renewing_leases([o for leases in missing.values() for o in leases.values()]), \
+            ThreadPoolExecutor(_batch_workers) as download_pool, ThreadPoolExecutor(_batch_workers) as calculation_pool:
+        downloads = {download_pool.submit(timing.bind(_fetch_audio), linked_id): linked_id for linked_id in missing}
+        calculations = {}
+        combined_calculations = set()
+        for download in as_completed(downloads):
+            linked_id = downloads[download]
+            try:
+                file_name, audio_path = download.result()
+            # Any failure only affects the descriptors of this id
+            except Exception as e:
+                for descriptor, lease_owner in missing[linked_id].items():
+                    errors[(linked_id, descriptor)] = str(e) or repr(e)
+                    _release_lease(linked_id, descriptor, lease_owner)
+                continue
+            grouped = [d for d in missing[linked_id] if d in _sonic_annotator_outputs]
+            if len(grouped) > 1:
+                combined = calculation_pool.submit(timing.bind(calculate_sonic_annotator_descriptors), file_name, audio_path, grouped)
+                combined_calculations.add(combined)
+                for descriptor in grouped:
+                    calculations[(linked_id, descriptor)] = combined
+            for descriptor in missing[linked_id]:
+                if (linked_id, descriptor) not in calculations:
+                    calculations[(linked_id, descriptor)] = calculation_pool.submit(timing.bind(calculate_descriptor), file_name, audio_path, descriptor)
+        # Descriptors calculated elsewhere are polled from here, leaving the workers to the calculations,
+        # and only those of which the calculation was given up take a worker to be calculated again
+        awaited_results = _wait_for_descriptors(awaited)
+        results.update(awaited_results)
+        for linked_id, descriptor in awaited:
+            if (linked_id, descriptor) not in awaited_results:
+                calculations[(linked_id, descriptor)] = calculation_pool.submit(timing.bind(get_descriptor), linked_id, descriptor)
+        for (linked_id, descriptor), calculation in calculations.items():
+            lease_owner = missing.get(linked_id, {}).get(descriptor)
+            try:
+                result_content = calculation.result()
+                if calculation in combined_calculations:
+                    if descriptor not in result_content:
+                        raise ValueError('Calculation of "{}" failed'.format(descriptor))
+                    result_content = result_content[descriptor]
+                results[(linked_id, descriptor)] = result_content
+                if lease_owner is not None:
+                    _store_descriptor(linked_id, descriptor, results[(linked_id, descriptor)])
+            except Exception as e:
+                results.pop((linked_id, descriptor), None)
+                errors[(linked_id, descriptor)] = str(e) or repr(e)
+            finally:
+                if lease_owner is not None:
+                    _release_lease(linked_id, descriptor, lease_owner)
+    return results, errors
+
+
+def content_id(digest):
+    """Id under which the descriptors of uploaded audio are stored, such that identical uploads are only analysed once
+
+    Args:
+        digest (str): SHA-256 hex digest of the audio, which the canonical audio is also cached under
+    """
+    return 'sha256:{}'.format(digest)
+
+
+def _fetch_audio(linked_id):
+    """Return the file name and the path of the canonical version of the audio of an id"""
+    if open_audio is None:
+        return canonical_audio.decode(*_download_audio(linked_id))
+    provider, provider_id = _split_id(linked_id)
+    # Stream the audio from the cache straight to disk
+    with open_audio(provider_id, provider) as (file_name, audio_stream):
+        return canonical_audio.decode(file_name, audio_stream)
+
+
+def _split_id(linked_id):
     try:
         provider, provider_id = linked_id.split(':')
     except ValueError:
         raise HTTPError('Malformed id "{}". Needs to be of the form "content-provider:provider-id"'.format(linked_id))
     if provider not in providers:
         raise HTTPError('Unknown content provider "{}". Allowed providers are : {}'.format(provider, providers))
-    uri = audio_uri(provider_id, provider)
+    return provider, provider_id
+
+
+def _download_audio(linked_id):
+    provider, provider_id = _split_id(linked_id)
+    with timing.stage('audio-uri'):
+        uri = audio_uri(provider_id, provider)
     file_name = os.path.basename(urlsplit(uri).path)
-    audio_content = requests.get(uri).content
+    with timing.stage('download'):
+        return file_name, _session.get(uri).content
+
+
+def _dispatch_job(job):
+    """Queue an asynchronous invocation running a job, leaving it to the workers when that fails"""
+    try:
+        _session.post('{}/async-function/ac-analysis/jobs'.format(_gateway), params={'job': job['_id']}, timeout=10).raise_for_status()
+    except requests.exceptions.RequestException as e:
+        sys.stderr.write('Could not queue job {}: {}\n'.format(job['_id'], e))
 
-    result_content = calculate_descriptor(file_name, audio_content, descriptor)
 
-    r = db.descriptors.update_one({'_id': linked_id}, {'$set': {descriptor: result_content}}, upsert=True)
+def _store_descriptor(linked_id, descriptor, result_content):
+    db = _get_db()
+    with timing.stage('store'):
+        r = db.descriptors.update_one({'_id': linked_id}, {'$set': _descriptor_fields(linked_id, descriptor, result_content, db)}, upsert=True)
+    _response_cache.invalidate(linked_id)
     sys.stderr.write('Result stored in DB: {}\n'.format(r.raw_result))
-    return result_content
 
 
-def calculate_descriptor(file_name, audio_content, descriptor):
+def _descriptor_fields(linked_id, descriptor, result_content, db):
+    """Fields of the descriptors collection to set when storing a descriptor"""
+    fields = {descriptor: stored_format.spill(stored_format.encode(result_content), db), 'updated': datetime.utcnow()}
+    fields.update(provider_field(linked_id))
+    fields.update(search_fields(descriptor, result_content))
+    return fields
+
+
+def _grouped_leases(linked_id, descriptor):
+    """Take the leases of the other sonic-annotator descriptors of an id that are neither stored nor being calculated
+
+    Returns the owner tokens of the leases by descriptor.
+    """
+    leases = {}
+    for other in _sonic_annotator_outputs:
+        if other != descriptor:
+            lease_owner = _acquire_lease(linked_id, other)
+            if lease_owner is not None:
+                leases[other] = lease_owner
+    if leases:
+        stored = _get_db().descriptors.find_one({'_id': linked_id}, {d: True for d in leases}) or {}
+        for other in [d for d in leases if d in stored]:
+            _release_lease(linked_id, other, leases.pop(other))
+    return leases
+
+
+def _acquire_lease(linked_id, descriptor):
+    """Try to become the single caller calculating a descriptor, across all replicas
+
+    Returns an owner token when the lease is acquired, either because nobody held it or because
+    the previous holder let it expire, or None when another caller is still calculating.
+    """
+    leases = _get_db().leases
+    owner = uuid.uuid4().hex
+    now = datetime.utcnow()
+    lease = {'owner': owner, 'acquired': now, 'expires': now + _lease_duration}
+    try:
+        leases.insert_one(dict(lease, _id={'id': linked_id, 'descriptor': descriptor}))
+        return owner
+    except pymongo.errors.DuplicateKeyError:
+        if leases.find_one_and_update({'_id': {'id': linked_id, 'descriptor': descriptor}, 'expires': {'$lt': now}}, {'$set': lease}) is not None:
+            sys.stderr.write('Took over expired lease for "{}" of "{}"\n'.format(descriptor, linked_id))
+            return owner
+        return None
+
+
+def _release_lease(linked_id, descriptor, owner):
+    _get_db().leases.delete_one({'_id': {'id': linked_id, 'descriptor': descriptor}, 'owner': owner})
+
+
+@contextlib.contextmanager
+def _renewing_leases(owners):
+    """Extend leases every quarter of their duration until the block ends"""
+    stop = threading.Event()
+
+    def renew():
+        while not stop.wait(_lease_duration.total_seconds() / 4):
+            try:
+                _get_db().leases.update_many({'owner': {'$in': owners}}, {'$set': {'expires': datetime.utcnow() + _lease_duration}})
+            except pymongo.errors.PyMongoError as e:
+                sys.stderr.write('Could not renew leases: {}\n'.format(e))
+
+    if owners:
+        threading.Thread(target=renew, daemon=True).start()
+    try:
+        yield
+    finally:
+        stop.set()
+
+
+def _wait_for_descriptor(linked_id, descriptor):
+    """Poll until another caller has stored a descriptor
+
+    Returns the descriptor, or None when the lease was released or expired without a result.
+    """
+    sys.stderr.write('Waiting for "{}" of "{}" to be calculated elsewhere\n'.format(descriptor, linked_id))
+    db = _get_db()
+    with timing.stage('lease-wait'):
+        while True:
+            result = db.descriptors.find_one({'_id': linked_id, descriptor: {'$exists': True}}, {descriptor: True})
+            if result is not None:
+                return stored_format.decode(result[descriptor], db)
+            if db.leases.find_one({'_id': {'id': linked_id, 'descriptor': descriptor}, 'expires': {'$gte': datetime.utcnow()}}) is None:
+                return None
+            time.sleep(_lease_poll_interval)
+
+
+def _wait_for_descriptors(keys):
+    """Poll until other callers have stored several descriptors at once
+
+    Returns the stored descriptors by (id, descriptor), without those of which the lease was released
+    or expired without a result.
+    """
+    db = _get_db()
+    results = {}
+    pending = set(keys)
+    with timing.stage('lease-wait'):
+        while pending:
+            projection = {descriptor: True for _, descriptor in pending}
+            for doc in db.descriptors.find({'_id': {'$in': list({linked_id for linked_id, _ in pending})}}, projection):
+                for descriptor in [d for d in doc if (doc['_id'], d) in pending]:
+                    results[(doc['_id'], descriptor)] = stored_format.decode(doc[descriptor], db)
+                    pending.discard((doc['_id'], descriptor))
+            if pending:
+                leases = db.leases.find({'_id': {'$in': [{'id': linked_id, 'descriptor': descriptor} for linked_id, descriptor in pending]},
+                                         'expires': {'$gte': datetime.utcnow()}}, {'_id': True})
+                pending &= {(lease['_id']['id'], lease['_id']['descriptor']) for lease in leases}
+            if pending:
+                time.sleep(_lease_poll_interval)
+    return results
+
+
+def calculate_descriptor(file_name, audio_path, descriptor):
     file_name = file_name.lstrip('/')
-    if descriptor == 'chords':
-        result = requests.get('http://gateway:8080/function/confident-chord-estimator/{}'.format(file_name), data=audio_content)
-    elif descriptor == 'essentia-music':
-        result = requests.get('http://gateway:8080/function/essentia/{}'.format(file_name), data=audio_content)
-    elif descriptor == 'instruments':
-        sa_arg = {'-t': '/home/app/transforms/instrument-probabilities.n3', '-w': 'jams', '--jams-stdout': ''}
-        result = requests.get('http://gateway:8080/function/instrument-identifier/{}'.format(file_name), data=audio_content, params=sa_arg)
+    url = '{}/function/{}/{}'.format(_gateway, backend_functions[descriptor], file_name)
+    if descriptor == 'instruments':
+        params = {'-t': '/home/app/transforms/instrument-probabilities.n3', '-w': 'jams', '--jams-stdout': ''}
+    elif backend_functions[descriptor] == 'sonic-annotator':
+        params = {'-t': '/home/app/transforms/{}.n3'.format(descriptor), '-w': 'jams', '--jams-stdout': ''}
     else:
-        sa_arg = {'-t': '/home/app/transforms/{}.n3'.format(descriptor), '-w': 'jams', '--jams-stdout': ''}
-        result = requests.get('http://gateway:8080/function/sonic-annotator/{}'.format(file_name), data=audio_content, params=sa_arg)
-
-    if result.status_code != requests.codes.ok or len(result.text) == 0:
+        params = None
+    with timing.stage('compute-' + backend_functions[descriptor]):
+        result = _backends.get(backend_functions[descriptor], url, audio_path, params)
+    if len(result.text) == 0:
         raise HTTPError('Calculation of "{}" failed'.format(descriptor))
     return result.json()
 
 
+def calculate_sonic_annotator_descriptors(file_name, audio_path, descriptors):
+    """Calculate several descriptors with a single sonic-annotator call running all their transforms
+
+    Returns a dict of results by descriptor, each with the annotations of its own transform only.
+    Descriptors that can't be found in the output are left out.
+    """
+    sa_arg = {'-t': ['/home/app/transforms/{}.n3'.format(d) for d in descriptors], '-w': 'jams', '--jams-stdout': ''}
+    with timing.stage('compute-sonic-annotator'):
+        result = _backends.get('sonic-annotator', '{}/function/sonic-annotator/{}'.format(_gateway, file_name.lstrip('/')), audio_path, sa_arg)
+    if len(result.text) == 0:
+        raise HTTPError('Calculation of "{}" failed'.format('", "'.join(descriptors)))
+    # The output of every transform might also come as a separate JAMS document
+    jams = []
+    decoder = json.JSONDecoder()
+    position = 0
+    text = result.text.strip()
+    while position < len(text):
+        document, position = decoder.raw_decode(text, position)
+        jams.append(document)
+        while position < len(text) and text[position].isspace():
+            position += 1
+    annotations = [a for document in jams for a in document.get('annotations', [])]
+    results = {}
+    for descriptor in descriptors:
+        matching = [a for a in annotations if _is_transform_output(a, *_sonic_annotator_outputs[descriptor])]
+        if matching:
+            results[descriptor] = dict(jams[0], annotations=matching)
+    return results
+
+
+def _is_transform_output(annotation, plugin, output):
+    """Whether a JAMS annotation of sonic-annotator comes from the given plugin output"""
+    ids = [v for v in annotation.get('annotation_metadata', {}).get('annotator', {}).values() if isinstance(v, str)]
+    return any(i.endswith('{}:{}'.format(plugin, output)) for i in ids) or (output in ids and any(plugin in i for i in ids))
+
+
+def _requested_descriptor(descriptor):
+    return 'essentia-music' if descriptor in ['tempo', 'global-key', 'tuning', 'beats'] else descriptor
+
+
 def _get_db():
     global _client
-    if _client is None:
-        sys.stderr.write('Connecting to DB\n')
-        _client = pymongo.MongoClient(os.getenv('MONGO_CONNECTION'))
-    sys.stderr.write('Connected to DB: {}\n'.format(_client))
+    with _init_lock:
+        if _client is None:
+            sys.stderr.write('Connecting to DB\n')
+            client = pymongo.MongoClient(os.getenv('MONGO_CONNECTION'))
+            client.ac_analysis_service.leases.create_index('expires', expireAfterSeconds=0)
+            jobs.create_indexes(client.ac_analysis_service)
+            if _shared_response_cache:
+                client.ac_analysis_service.rendered_responses.create_index('created', expireAfterSeconds=int(os.getenv('RESPONSE_CACHE_SHARED_TTL', 86400)))
+            _client = client
+            sys.stderr.write('Connected to DB: {}\n'.format(_client))
     return _client.ac_analysis_service
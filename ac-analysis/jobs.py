@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""Job records of asynchronous descriptor requests
+
+Instead of holding the connection open while a missing descriptor is calculated, a request can get a
+job straight away. Jobs are kept in the jobs collection with their state (queued, running, done or
+failed), timings and error, and the descriptor itself is stored in the descriptors collection as for
+synchronous requests. Jobs of which the runner disappeared are queued again once they expire.
+
+Jobs are run by asynchronous invocations of the function through the gateway queue. The queue-worker
+redelivers an invocation that isn't acknowledged within its ack_wait, so that needs to be longer than
+the exec_timeout of the function (e.g. ack_wait=360s for 330s). Running this module starts workers that
+claim queued jobs from the collection instead, for deployments without queue or to catch up with jobs
+that couldn't be queued.
+
+Unfinished jobs are marked with "unfinished", on which a partial unique index keeps a single unfinished
+job per id and descriptor, also when several replicas submit one at the same time.
+"""
+import os
+import sys
+import time
+import uuid
+import argparse
+import threading
+import pymongo
+from datetime import datetime
+
+
+job_ttl = int(os.getenv('JOB_TTL', 7*86400))
+
+
+def create_indexes(db):
+    db.jobs.create_index([('state', pymongo.ASCENDING), ('submitted', pymongo.ASCENDING)])
+    db.jobs.create_index([('id', pymongo.ASCENDING), ('descriptor', pymongo.ASCENDING)], name='unfinished_id_descriptor',
+                         unique=True, partialFilterExpression={'unfinished': True})
+    db.jobs.create_index('finished', expireAfterSeconds=job_ttl)
+
+
+def submit(db, linked_id, descriptor):
+    """Return the unfinished job for a descriptor, creating one if there is none
+
+    Returns the job and whether it still needs to be dispatched to a runner, which is the case for
+    new jobs and for expired ones that are queued again.
+    """
+    while True:
+        now = datetime.utcnow()
+        job = db.jobs.find_one_and_update({'id': linked_id, 'descriptor': descriptor, 'state': 'running', 'expires': {'$lt': now}},
+                                          {'$set': {'state': 'queued', 'expires': None}}, return_document=pymongo.ReturnDocument.AFTER)
+        if job is not None:
+            sys.stderr.write('Queued expired job {} again\n'.format(job['_id']))
+            return job, True
+        job = db.jobs.find_one({'id': linked_id, 'descriptor': descriptor, 'unfinished': True})
+        if job is not None:
+            return job, False
+        job = {'_id': uuid.uuid4().hex, 'id': linked_id, 'descriptor': descriptor, 'state': 'queued', 'submitted': now,
+               'started': None, 'finished': None, 'expires': None, 'attempts': 0, 'error': None, 'unfinished': True}
+        try:
+            db.jobs.insert_one(job)
+            return job, True
+        except pymongo.errors.DuplicateKeyError:
+            # Another request submitted the same job at the same time, look it up again
+            pass
+
+
+def claim(db, duration, job_id=None):
+    """Mark a queued or expired job as running and return it, or return None when there is nothing to run
+
+    Args:
+        duration (timedelta): time after which the job is considered abandoned
+        job_id (str): job to claim, or None for the oldest queued job
+    """
+    now = datetime.utcnow()
+    query = {'$or': [{'state': 'queued'}, {'state': 'running', 'expires': {'$lt': now}}]}
+    if job_id is not None:
+        query['_id'] = job_id
+    return db.jobs.find_one_and_update(query, {'$set': {'state': 'running', 'started': now, 'expires': now + duration}, '$inc': {'attempts': 1}},
+                                       sort=[('submitted', pymongo.ASCENDING)], return_document=pymongo.ReturnDocument.AFTER)
+
+
+def complete(db, job, error=None):
+    """Record the outcome of a running job and return it"""
+    fields = {'state': 'failed' if error else 'done', 'finished': datetime.utcnow(), 'expires': None, 'error': error}
+    return db.jobs.find_one_and_update({'_id': job['_id'], 'started': job['started']}, {'$set': fields, '$unset': {'unfinished': ''}},
+                                       return_document=pymongo.ReturnDocument.AFTER) or db.jobs.find_one({'_id': job['_id']})
+
+
+def wait(db, job_id, timeout, poll_interval):
+    """Return a job once it is finished or after timeout seconds, whichever comes first, or None if it doesn't exist"""
+    deadline = time.monotonic() + timeout
+    while True:
+        job = db.jobs.find_one({'_id': job_id})
+        if job is None or job['state'] in ['done', 'failed'] or time.monotonic() + poll_interval > deadline:
+            return job
+        time.sleep(poll_interval)
+
+
+def to_response(job):
+    response = {'job': job['_id'], 'id': job['id'], 'descriptor': job['descriptor'], 'state': job['state'], 'attempts': job['attempts']}
+    for field in ['submitted', 'started', 'finished']:
+        response[field] = job[field].isoformat() + 'Z' if job[field] else None
+    if job['started']:
+        response['queued_time'] = (job['started'] - job['submitted']).total_seconds()
+    if job['finished']:
+        response['run_time'] = (job['finished'] - job['started']).total_seconds()
+    if job['error']:
+        response['error'] = job['error']
+    return response
+
+
+if __name__ == '__main__':
+    from . import handler
+
+    parser = argparse.ArgumentParser(description='Run queued descriptor jobs')
+    parser.add_argument('--workers', type=int, default=handler._batch_workers, help='number of jobs run at once')
+    parser.add_argument('--poll-interval', type=float, default=5, help='seconds between looking for new jobs when idle')
+    args = parser.parse_args()
+
+    def work():
+        while True:
+            if handler.run_job() is None:
+                time.sleep(args.poll_interval)
+
+    create_indexes(handler._get_db())
+    workers = [threading.Thread(target=work, daemon=True) for _ in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    sys.stderr.write('Started {} job workers\n'.format(len(workers)))
+    for worker in workers:
+        worker.join()
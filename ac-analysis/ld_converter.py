@@ -71,7 +71,8 @@
 #  \____\___/|____/|_____|
 
 from rdflib import Graph, BNode, Namespace, RDF, XSD, URIRef, RDFS, Literal
-from collections import OrderedDict, Mapping
+from collections import OrderedDict
+from collections.abc import Mapping
 from copy import deepcopy
 import logging
 import json
@@ -163,6 +164,8 @@ def json_sort(json_object, key_listing):
 
 
 def convert(descriptor, result_dict, output_format):
+    if output_format == 'json-ld' and descriptor in ["chords", "instruments", "beats-beatroot", "keys"]:
+        return convert_json_ld(descriptor, result_dict)
     if descriptor == "chords":
         serialised = convert_chords(result_dict, output_format)
     elif descriptor in ["instruments", "beats-beatroot", "keys"]:
@@ -181,6 +184,75 @@ def convert(descriptor, result_dict, output_format):
         return serialised
 
 
+def convert_json_ld(descriptor, result_dict):
+    """Build the ordered JSON-LD document in one pass, with the same triples as the rdflib graphs below
+
+    Blank nodes get sequential ids and every node is a top-level object of the graph, with its keys in
+    the order that convert used to sort them in. Numbers and booleans are native JSON values, which
+    map to the same typed literals as rdflib assigns to Python numbers and booleans.
+    """
+    builder = _JsonLdBuilder()
+    if descriptor == "chords":
+        collection_bnode = builder.bnode()
+        builder.node("ns:chords{}".format(result_dict["id"]), "afo:AudioFeature",
+                     {"afo:collection": {"@id": collection_bnode}, "afo:confidence": _literal(result_dict["confidence"])})
+        seq_ids = ["ns:seq{}".format(seq_id) for seq_id in range(len(result_dict["chordSequence"]))]
+        builder.node(collection_bnode, "collection:Collection", {"collection:hasElement": [{"@id": i} for i in seq_ids]})
+        for seq_uri, seq in zip(seq_ids, result_dict["chordSequence"]):
+            interval_bnode = builder.bnode()
+            builder.node(seq_uri, ["afo:AudioFeature", "afo:Segment"], {"event:time": {"@id": interval_bnode}})
+            builder.node(interval_bnode, "timeline:Interval", {"timeline:start": _literal(seq["start"]),
+                         "timeline:end": _literal(seq["end"]), "rdfs:label": _literal(seq["label"])})
+    else:
+        annotations_bnode = builder.bnode()
+        builder.node("ns:_{}_{}".format(descriptor, result_dict["id"]), "afo:AudioFeature", {"afo:collection": {"@id": annotations_bnode}})
+        annotation_ids = ["ns:annotation{}".format(index) for index in range(len(result_dict["annotations"]))]
+        builder.node(annotations_bnode, "collection:Collection", {"collection:hasElement": [{"@id": i} for i in annotation_ids]})
+        for annotation_uri, annotation in zip(annotation_ids, result_dict["annotations"]):
+            data_bnode = builder.bnode()
+            builder.node(annotation_uri, "afo:AudioFeature", {"afo:collection": {"@id": data_bnode}})
+            entry_ids = ["ns:data{}".format(sub_index) for sub_index in range(len(annotation["data"]))]
+            builder.node(data_bnode, "collection:Collection", {"collection:hasElement": [{"@id": i} for i in entry_ids]})
+            for entry_uri, entry in zip(entry_ids, annotation["data"]):
+                interval_bnode = builder.bnode()
+                properties = {}
+                if "label" in entry.keys():
+                    properties["rdfs:label"] = _literal(entry["label"])
+                properties["afo:confidence"] = _literal(entry["confidence"])
+                if "value" in entry.keys():
+                    if isinstance(entry["value"], list):
+                        properties["afo:value"] = [_literal(data) for data in entry["value"]]
+                    else:
+                        properties["afo:value"] = _literal(entry["value"])
+                properties["event:time"] = {"@id": interval_bnode}
+                builder.node(entry_uri, ["afo:AudioFeature", "afo:Segment"], properties)
+                builder.node(interval_bnode, "timeline:Interval", {"timeline:start": _literal(entry["time"]),
+                             "timeline:duration": _literal(entry["duration"])})
+    return OrderedDict([("@context", context), ("@graph", builder.graph)])
+
+
+class _JsonLdBuilder:
+    def __init__(self):
+        self.graph = []
+        self.num_bnodes = 0
+
+    def bnode(self):
+        self.num_bnodes += 1
+        return "_:b{}".format(self.num_bnodes - 1)
+
+    def node(self, node_id, node_type, properties):
+        node = OrderedDict([("@id", node_id), ("@type", node_type)])
+        node.update(properties)
+        self.graph.append(node)
+
+
+def _literal(value):
+    """JSON-LD value of the literal that rdflib creates for a Python value"""
+    if isinstance(value, (bool, int, float, str)):
+        return value
+    return str(value)
+
+
 def convert_chords(result_dict, output_format):
     # setting up namespaces
     g = Graph()
@@ -206,7 +278,7 @@ def convert_chords(result_dict, output_format):
         g.add((chordSeqInterval, timeline.start, Literal(seq["start"])))
         g.add((chordSeqInterval, timeline.end, Literal(seq["end"])))
         g.add((chordSeqInterval, RDFS.label, Literal(seq["label"])))
-    return g.serialize(format=output_format, context=context).decode("utf-8")
+    return _serialize(g, output_format)
 
 
 def convert_jams(result_dict, output_format, descriptor):
@@ -252,7 +324,14 @@ def convert_jams(result_dict, output_format, descriptor):
                         g.add((entryURI, afo.value, Literal(data)))
                 else:
                     g.add((entryURI, afo.value, Literal(entry["value"])))
-    return g.serialize(format=output_format, context=context).decode("utf-8")
+    return _serialize(g, output_format)
+
+
+def _serialize(g, output_format):
+    serialised = g.serialize(format=output_format, context=context)
+    # rdflib 6 and later return a str
+    return serialised.decode("utf-8") if isinstance(serialised, bytes) else serialised
+
 
 def convert_essentia(result_dict, output_format):
     raise NotImplementedError
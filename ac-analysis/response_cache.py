@@ -0,0 +1,94 @@
+"""Cache of rendered responses by (id, descriptor, content-type)
+
+Responses are kept in an in-memory LRU bounded by their total size, in front of an optional tier in a
+Mongo collection shared by all replicas. Storing a descriptor invalidates all responses of its id,
+but only in this replica and the shared tier, so in-memory entries also expire after a while.
+"""
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+
+class ResponseCache:
+    def __init__(self, max_size, ttl, shared_collection=None):
+        """
+        Args:
+            max_size (int): maximum total length of the responses kept in memory
+            ttl (float): seconds after which in-memory entries expire
+            shared_collection (callable): returns the collection of the shared tier, or None without one
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.shared_collection = shared_collection
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Return the (response, etag) cached for a key, or None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if time.monotonic() - entry[2] < self.ttl:
+                    self.entries.move_to_end(key)
+                    return entry[0], entry[1]
+                self._remove(key)
+        collection = self.shared_collection() if self.shared_collection else None
+        if collection is not None:
+            doc = collection.find_one({'_id': _shared_id(key)})
+            if doc is not None:
+                self._put_local(key, doc['response'], doc['etag'])
+                return doc['response'], doc['etag']
+        return None
+
+    def put(self, key, response):
+        """Cache a response and return its strong ETag"""
+        etag = etag_of(response)
+        self._put_local(key, response, etag)
+        collection = self.shared_collection() if self.shared_collection else None
+        if collection is not None:
+            collection.replace_one({'_id': _shared_id(key)}, {'response': response, 'etag': etag, 'created': datetime.utcnow()}, upsert=True)
+        return etag
+
+    def invalidate(self, linked_id):
+        """Drop the responses of all descriptors of an id"""
+        with self.lock:
+            for key in [k for k in self.entries if k[0] == linked_id]:
+                self._remove(key)
+        collection = self.shared_collection() if self.shared_collection else None
+        if collection is not None:
+            collection.delete_many({'_id.id': linked_id})
+
+    def _put_local(self, key, response, etag):
+        if len(response) > self.max_size:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (response, etag, time.monotonic())
+            self.size += len(response)
+            while self.size > self.max_size:
+                self._remove(next(iter(self.entries)))
+
+    def _remove(self, key):
+        self.size -= len(self.entries.pop(key)[0])
+
+
+def etag_of(response):
+    return '"{}"'.format(hashlib.sha256(response if isinstance(response, bytes) else response.encode()).hexdigest()[:32])
+
+
+def etag_matches(if_none_match, etag):
+    """Whether an If-None-Match header value matches an ETag"""
+    if not if_none_match:
+        return False
+    # If-None-Match uses the weak comparison
+    tags = [t.strip() for t in if_none_match.split(',')]
+    return '*' in tags or etag in [t[2:] if t.startswith('W/') else t for t in tags]
+
+
+def _shared_id(key):
+    linked_id, descriptor, content_type = key
+    return {'id': linked_id, 'descriptor': descriptor, 'content_type': content_type}
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""Materialised search fields for the descriptors collection
+
+The ac-search service filters and sorts on values that are buried inside the stored descriptors
+(e.g. the best of three key estimations, or the set of chords in a track). Instead of recomputing
+them in every aggregation, they are written next to the descriptor in a "search" sub-document,
+such that they can be indexed. Every document also stores its content provider, which prefixes
+compound indexes with the search fields, such that restricting a search to some providers is an
+equality match on the index prefix. Running this file as a script creates the indexes and
+backfills the provider and search fields of documents stored before they existed.
+"""
+import os
+import sys
+import pymongo
+from datetime import datetime
+
+
+_key_variants = ['edma', 'krumhansl', 'temperley']
+_search_indexes = [
+    [('search.tempo', pymongo.ASCENDING)],
+    [('search.tuning', pymongo.ASCENDING)],
+    [('search.keys.key', pymongo.ASCENDING), ('search.keys.scale', pymongo.ASCENDING)],
+    [('search.key.strength', pymongo.DESCENDING)],
+    [('search.chords', pymongo.ASCENDING)],
+]
+indexes = [[('provider', pymongo.ASCENDING)], [('updated', pymongo.ASCENDING)]] + _search_indexes + [[('provider', pymongo.ASCENDING)] + keys for keys in _search_indexes]
+
+
+def search_fields(descriptor, result):
+    """Return the search fields derived from a descriptor result, as a dict of dotted field names"""
+    if descriptor == 'essentia-music':
+        keys = [{'key': result['tonal'][k]['key'], 'scale': result['tonal'][k]['scale'], 'strength': result['tonal'][k]['strength']}
+                for k in ['key_{}'.format(v) for v in _key_variants] if k in result['tonal']]
+        fields = {'search.tempo': result['rhythm']['bpm'],
+                  'search.tuning': result['tonal']['tuning_frequency'],
+                  'search.keys': keys}
+        if keys:
+            fields['search.key'] = max(keys, key=lambda k: k['strength'])
+        return fields
+    elif descriptor == 'chords':
+        return {'search.chords': [label for label, ratio in result['chordRatio'].items() if ratio > 0]}
+    else:
+        return {}
+
+
+def provider_field(linked_id):
+    return {'provider': linked_id.split(':')[0]}
+
+
+def create_indexes(db):
+    for keys in indexes:
+        name = db.descriptors.create_index(keys)
+        sys.stderr.write('Created index {}\n'.format(name))
+
+
+def backfill(db, batch_size=1000):
+    """Add the provider to all documents without one, and the search fields to all documents that
+    have a descriptor but not its search fields
+
+    Rewritten documents get a new "updated" time, such that the search engines of ac-search reload them.
+    """
+    r = db.descriptors.update_many({'provider': {'$exists': False}},
+                                   [{'$set': {'provider': {'$arrayElemAt': [{'$split': ['$_id', ':']}, 0]}, 'updated': datetime.utcnow()}}])
+    sys.stderr.write('Backfilled provider of {} documents\n'.format(r.modified_count))
+    missing = {'essentia-music': 'search.tempo', 'chords': 'search.chords'}
+    num_updated = 0
+    for descriptor, field in missing.items():
+        updates = []
+        cursor = db.descriptors.find({descriptor: {'$exists': True}, field: {'$exists': False}}, {descriptor: True})
+        for doc in cursor:
+            updates.append(pymongo.UpdateOne({'_id': doc['_id']}, {'$set': dict(search_fields(descriptor, doc[descriptor]), updated=datetime.utcnow())}))
+            if len(updates) == batch_size:
+                num_updated += db.descriptors.bulk_write(updates, ordered=False).modified_count
+                updates = []
+        if updates:
+            num_updated += db.descriptors.bulk_write(updates, ordered=False).modified_count
+    sys.stderr.write('Backfilled search fields of {} documents\n'.format(num_updated))
+
+
+if __name__ == '__main__':
+    db = pymongo.MongoClient(os.getenv('MONGO_CONNECTION')).ac_analysis_service
+    create_indexes(db)
+    backfill(db)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""Compact storage layout of descriptor results
+
+Long lists of floats are packed into binary float64 arrays, and long lists of objects with the same
+fields, such as the chord sequence or the data of JAMS annotations, into one packed column per field,
+with strings coded into a dictionary. Both are lossless. The biggest fields of a result that is still
+too large are moved into GridFS and replaced by a reference, to keep the descriptors collection small
+enough to stay in memory. Documents stored before are read as they are.
+
+Running this module rewrites the existing documents of the descriptors collection in this layout.
+"""
+import os
+import sys
+import bson
+import gridfs
+import pymongo
+import numpy as np
+from datetime import datetime
+
+
+min_packed_length = int(os.getenv('PACKED_MIN_LENGTH', 16))
+max_inline_size = int(os.getenv('MAX_INLINE_SIZE', 1024*1024))
+gridfs_collection = 'results'
+descriptor_fields = ['essentia-music', 'chords', 'instruments', 'keys', 'beats-beatroot']
+
+
+def encode(value):
+    """Encode a descriptor result into the compact layout"""
+    if isinstance(value, dict):
+        return {k: encode(v) for k, v in value.items()}
+    elif isinstance(value, list):
+        if len(value) >= min_packed_length:
+            if all(type(v) is float for v in value):
+                return _pack(value)
+            if all(type(v) is dict for v in value) and all(v.keys() == value[0].keys() for v in value):
+                return {'_columns': {k: _column([v[k] for v in value]) for k in value[0]}, 'length': len(value)}
+        return [encode(v) for v in value]
+    return value
+
+
+def decode(value, db=None):
+    """Decode a descriptor result from the compact layout, reading references from the GridFS of db"""
+    if isinstance(value, dict):
+        if '_packed' in value:
+            return np.frombuffer(value['data'], dtype=value['_packed']).tolist()
+        elif '_coded' in value:
+            return [value['dictionary'][c] for c in np.frombuffer(value['data'], dtype=value['_coded']).tolist()]
+        elif '_columns' in value:
+            columns = {k: decode(v, db) for k, v in value['_columns'].items()}
+            return [dict(zip(columns, row)) for row in zip(*columns.values())] if columns else [{}] * value['length']
+        elif '_gridfs' in value:
+            return decode(bson.decode(gridfs.GridFS(db, gridfs_collection).get(value['_gridfs']).read())['value'], db)
+        return {k: decode(v, db) for k, v in value.items()}
+    elif isinstance(value, list):
+        return [decode(v, db) for v in value]
+    return value
+
+
+def spill(value, db):
+    """Move the biggest fields of an encoded result into the GridFS of db until the rest fits inline"""
+    if not isinstance(value, dict):
+        return value
+    value = dict(value)
+    fs = None
+    while len(bson.encode(value)) > max_inline_size:
+        sizes = {k: len(bson.encode({'value': v})) for k, v in value.items() if not (isinstance(v, dict) and '_gridfs' in v)}
+        if not sizes:
+            break
+        field = max(sizes, key=sizes.get)
+        fs = fs or gridfs.GridFS(db, gridfs_collection)
+        value[field] = {'_gridfs': fs.put(bson.encode({'value': value[field]}))}
+    return value
+
+
+def _pack(values):
+    return {'_packed': '<f8', 'data': bson.Binary(np.array(values, dtype='<f8').tobytes())}
+
+
+def _column(values):
+    if all(type(v) is float for v in values):
+        return _pack(values)
+    elif all(type(v) is str for v in values):
+        dictionary = list(dict.fromkeys(values))
+        codes = {v: i for i, v in enumerate(dictionary)}
+        dtype = '<u1' if len(dictionary) <= 1 << 8 else '<u2' if len(dictionary) <= 1 << 16 else '<u4'
+        return {'_coded': dtype, 'dictionary': dictionary, 'data': bson.Binary(np.array([codes[v] for v in values], dtype=dtype).tobytes())}
+    return [encode(v) for v in values]
+
+
+def _is_encoded(value):
+    if isinstance(value, dict):
+        return any(k in value for k in ['_packed', '_coded', '_columns', '_gridfs']) or any(_is_encoded(v) for v in value.values())
+    elif isinstance(value, list):
+        return any(_is_encoded(v) for v in value)
+    return False
+
+
+def compact(db, batch_size=100):
+    """Rewrite the documents of the descriptors collection that are not in the compact layout yet
+
+    Rewritten documents get a new "updated" time, such that the search engines of ac-search reload them.
+    """
+    updates = []
+    num_updated = 0
+    for doc in db.descriptors.find({}, {d: True for d in descriptor_fields}, batch_size=batch_size):
+        fields = {d: spill(encode(doc[d]), db) for d in descriptor_fields if d in doc and not _is_encoded(doc[d])}
+        fields = {d: v for d, v in fields.items() if v != doc[d]}
+        if fields:
+            updates.append(pymongo.UpdateOne({'_id': doc['_id']}, {'$set': dict(fields, updated=datetime.utcnow())}))
+        if len(updates) >= batch_size:
+            num_updated += db.descriptors.bulk_write(updates, ordered=False).modified_count
+            updates = []
+    if updates:
+        num_updated += db.descriptors.bulk_write(updates, ordered=False).modified_count
+    return num_updated
+
+
+if __name__ == '__main__':
+    db = pymongo.MongoClient(os.getenv('MONGO_CONNECTION')).ac_analysis_service
+    sys.stderr.write('Compacted {} documents\n'.format(compact(db)))
@@ -0,0 +1,296 @@
+"""In-memory columnar search engine
+
+Keeps the fields that can be searched on in NumPy columns, such that a search is a handful of
+vectorised comparisons followed by a partial sort of the matching rows, instead of an aggregation
+over the descriptors collection. It is refreshed incrementally from the collection, using the
+"updated" timestamp written with every stored descriptor as watermark, and returns the same
+results in the same order as the aggregation pipelines of the handler.
+"""
+import sys
+import time
+import threading
+import itertools
+from datetime import timedelta
+import numpy as np
+import pymongo
+
+
+chord_labels = [''.join(x) for x in itertools.product(['A', 'Bb', 'B', 'C', 'Db', 'D', 'Eb', 'E', 'F', 'Gb', 'G', 'Ab'], ['maj', 'min', '7', 'maj7', 'min7'])]
+_chord_index = {label: i for i, label in enumerate(chord_labels)}
+_num_key_variants = 3
+_projection = {'provider': True, 'search.tempo': True, 'search.tuning': True, 'search.keys': True,
+               'chords.chordRatio': True, 'chords.confidence': True, 'updated': True}
+# overlap with the previous refresh, to catch writes from replicas with a lagging clock
+_watermark_overlap = timedelta(seconds=60)
+
+
+class ColumnStore:
+    """Columns of the searchable fields of all descriptor documents
+
+    Memory use is dominated by the chord ratio matrix, which takes 60 doubles per document.
+    Documents deleted from the collection are only removed by a full reload.
+    """
+    def __init__(self, collection, refresh_interval=10.):
+        self.collection = collection
+        self.refresh_interval = refresh_interval
+        self.watermark = None
+        self.last_refresh = None
+        self.lock = threading.Lock()
+        self.providers = []
+        self.keys = []
+        self.scales = []
+        self.ids = np.empty(0, dtype=object)
+        self.id_rank = np.empty(0, dtype=np.int64)
+        self.rows = {}
+        self.provider = np.empty(0, dtype=np.int16)
+        self.tempo = np.empty(0)
+        self.tuning = np.empty(0)
+        self.key = np.empty((0, _num_key_variants), dtype=np.int16)
+        self.scale = np.empty((0, _num_key_variants), dtype=np.int16)
+        self.key_strength = np.empty((0, _num_key_variants))
+        self.has_chords = np.empty(0, dtype=bool)
+        self.chord_confidence = np.empty(0)
+        self.chord_ratio = np.empty((0, len(chord_labels)))
+
+    def refresh(self, force=False):
+        """Load all documents updated since the previous refresh, if it is older than the refresh interval"""
+        with self.lock:
+            if not force and self.last_refresh is not None and time.monotonic() - self.last_refresh < self.refresh_interval:
+                return
+            start = time.monotonic()
+            if self.watermark is None:
+                cursor = self.collection.find({}, _projection)
+            else:
+                cursor = self.collection.find({'updated': {'$gte': self.watermark - _watermark_overlap}}, _projection)
+            num_docs = self._load(cursor)
+            self.last_refresh = time.monotonic()
+            sys.stderr.write('Loaded {} documents into column store in {:.3f}s\n'.format(num_docs, self.last_refresh - start))
+
+    def _load(self, docs):
+        new_rows = []
+        updates = []
+        for doc in docs:
+            if doc.get('updated') is not None and (self.watermark is None or doc['updated'] > self.watermark):
+                self.watermark = doc['updated']
+            values = self._row_values(doc)
+            if doc['_id'] in self.rows:
+                updates.append((self.rows[doc['_id']], values))
+            else:
+                new_rows.append((doc['_id'], values))
+
+        for row, values in updates:
+            for column, value in values.items():
+                getattr(self, column)[row] = value
+        if new_rows:
+            first_row = len(self.ids)
+            num_rows = first_row + len(new_rows)
+            self.ids = np.concatenate((self.ids, np.array([i for i, _ in new_rows], dtype=object)))
+            for i, (linked_id, _) in enumerate(new_rows):
+                self.rows[linked_id] = first_row + i
+            self.provider = np.resize(self.provider, num_rows)
+            self.tempo = np.resize(self.tempo, num_rows)
+            self.tuning = np.resize(self.tuning, num_rows)
+            self.key = np.resize(self.key, (num_rows, _num_key_variants))
+            self.scale = np.resize(self.scale, (num_rows, _num_key_variants))
+            self.key_strength = np.resize(self.key_strength, (num_rows, _num_key_variants))
+            self.has_chords = np.resize(self.has_chords, num_rows)
+            self.chord_confidence = np.resize(self.chord_confidence, num_rows)
+            self.chord_ratio = np.resize(self.chord_ratio, (num_rows, len(chord_labels)))
+            for column in new_rows[0][1]:
+                getattr(self, column)[first_row:] = np.array([values[column] for _, values in new_rows])
+            # rank of the ids in the binary string order that MongoDB sorts them in
+            self.id_rank = np.empty(num_rows, dtype=np.int64)
+            self.id_rank[np.argsort(self.ids.astype(str), kind='stable')] = np.arange(num_rows)
+        return len(updates) + len(new_rows)
+
+    def _row_values(self, doc):
+        search = doc.get('search', {})
+        keys = search.get('keys', [])[:_num_key_variants]
+        chords = doc.get('chords')
+        chord_ratio = np.zeros(len(chord_labels))
+        if chords is not None:
+            for label, ratio in chords.get('chordRatio', {}).items():
+                if label in _chord_index:
+                    chord_ratio[_chord_index[label]] = ratio
+        return {
+            'provider': _code(self.providers, doc.get('provider')),
+            'tempo': _float(search.get('tempo')),
+            'tuning': _float(search.get('tuning')),
+            'key': [_code(self.keys, k['key']) for k in keys] + [-1] * (_num_key_variants - len(keys)),
+            'scale': [_code(self.scales, k['scale']) for k in keys] + [-1] * (_num_key_variants - len(keys)),
+            'key_strength': [k['strength'] for k in keys] + [np.nan] * (_num_key_variants - len(keys)),
+            'has_chords': chords is not None,
+            'chord_confidence': _float(chords.get('confidence')) if chords is not None else np.nan,
+            'chord_ratio': chord_ratio,
+        }
+
+    @staticmethod
+    def sort_keys(conditions):
+        """Return the sort keys of a search, as named in the aggregation pipeline"""
+        sort_keys = []
+        for descriptor, condition in conditions:
+            if condition is None or descriptor == 'providers':
+                continue
+            if descriptor in ['tempo', 'tuning']:
+                if condition[0] == 'range':
+                    sort_keys = [('distance', pymongo.ASCENDING)]
+                else:
+                    sort_keys = [('search.{}'.format(descriptor), pymongo.DESCENDING if condition[0] in ['$lte', '$lt'] else pymongo.ASCENDING)]
+            elif descriptor == 'global-key':
+                sort_keys = [('key_best_matching.strength', pymongo.DESCENDING)]
+            elif descriptor == 'chords':
+                sort_keys = [('coveredChords', pymongo.DESCENDING), ('chords.confidence', pymongo.DESCENDING)]
+        return sort_keys + [('_id', pymongo.ASCENDING)]
+
+    def search(self, conditions, num_results, offset=0, after=None):
+        """Search with conditions as returned by handler.search_conditions
+
+        Returns the results and their sort values. When the sort values of a previous result are
+        passed as after, only the results that sort after it are returned.
+        """
+        self.refresh()
+        # Refreshes replace and resize the columns, so they are only read under the lock
+        with self.lock:
+            results, sort_values, chord_ids = self._search(conditions, num_results, offset, after)
+        if chord_ids is not None:
+            self._add_chords(results, chord_ids)
+        return results, sort_values
+
+    def _search(self, conditions, num_results, offset, after):
+        mask = np.ones(len(self.ids), dtype=bool)
+        columns = {'_id': self.id_rank}
+        best_key = None
+        for descriptor, condition in conditions:
+            if descriptor == 'providers':
+                mask &= np.isin(self.provider, [self.providers.index(p) for p in condition if p in self.providers])
+            elif descriptor in ['tempo', 'tuning'] and condition:
+                values = getattr(self, descriptor)
+                if condition[0] == 'range':
+                    _, lower, upper, target_value = condition
+                    mask &= (values >= lower) & (values < upper)
+                    columns['distance'] = np.abs(target_value - values)
+                else:
+                    operator, value = condition
+                    mask &= {'$lte': np.less_equal, '$gte': np.greater_equal, '$lt': np.less, '$gt': np.greater}[operator](values, value)
+                    columns['search.{}'.format(descriptor)] = values
+            elif descriptor == 'global-key':
+                if condition:
+                    tonic, scale = condition
+                    matching = self.key >= 0
+                    if tonic:
+                        matching &= self.key == (self.keys.index(tonic) if tonic in self.keys else -2)
+                    if scale:
+                        matching &= self.scale == (self.scales.index(scale) if scale in self.scales else -2)
+                    mask &= matching.any(axis=1)
+                else:
+                    matching = self.key >= 0
+                best_key = np.where(matching.any(axis=1), np.argmax(np.where(matching, self.key_strength, -np.inf), axis=1), -1)
+                columns['key_best_matching.strength'] = np.where(best_key >= 0, self.key_strength[np.arange(len(best_key)), best_key], np.nan)
+            elif descriptor == 'chords' and condition:
+                chords, coverage = condition
+                ratios = self.chord_ratio[:, [_chord_index[c] for c in chords]]
+                covered = _accurate_sum(ratios)
+                mask &= covered >= coverage
+                columns['coveredChords'] = (ratios > 0).sum(axis=1)
+                columns['chords.confidence'] = self.chord_confidence
+
+        sort_keys = self.sort_keys(conditions)
+        rows = np.flatnonzero(mask)
+        keys = [_ascending(columns[field][rows], direction) for field, direction in sort_keys]
+        if after is not None:
+            later = self._sorts_after(rows, keys, sort_keys, after)
+            rows = rows[later]
+            keys = [k[later] for k in keys]
+        rows = rows[_top_k(keys, offset + num_results)[offset:]]
+
+        results = []
+        sort_values = []
+        for row in rows:
+            result = {'id': self.ids[row]}
+            for descriptor, condition in conditions:
+                if descriptor in ['tempo', 'tuning'] and not np.isnan(getattr(self, descriptor)[row]):
+                    result[descriptor] = getattr(self, descriptor)[row].item()
+                elif descriptor == 'global-key':
+                    if best_key[row] >= 0:
+                        result['global-key'] = {'key': '{} {}'.format(self.keys[self.key[row, best_key[row]]], self.scales[self.scale[row, best_key[row]]]),
+                                                'confidence': self.key_strength[row, best_key[row]].item()}
+                    else:
+                        result['global-key'] = {'key': None}
+            results.append(result)
+            sort_values.append([self.ids[row] if field == '_id' else _item(columns[field][row]) for field, _ in sort_keys])
+
+        chord_ids = None
+        if any(descriptor == 'chords' for descriptor, _ in conditions):
+            chord_ids = [r['id'] for r, row in zip(results, rows) if self.has_chords[row]]
+        return results, sort_values, chord_ids
+
+    def _sorts_after(self, rows, keys, sort_keys, after):
+        """Mask of the rows that sort strictly after the sort values of a previous result"""
+        later = np.zeros(len(rows), dtype=bool)
+        equal = np.ones(len(rows), dtype=bool)
+        for key, value, (_, direction) in zip(keys[:-1], after[:-1], sort_keys[:-1]):
+            value = _ascending(np.array([np.nan if value is None else value]), direction)[0]
+            later |= equal & (key > value)
+            equal &= key == value
+        return later | (equal & np.asarray(self.ids[rows] > after[-1], dtype=bool))
+
+    def _add_chords(self, results, page_ids):
+        chords = {doc['_id']: doc['chords'] for doc in self.collection.aggregate([
+            {'$match': {'_id': {'$in': page_ids}}},
+            {'$project': {'chords': True}},
+            {'$project': {'chords.distinctChords': False, 'chords.chordRatio': False}},
+        ]) if 'chords' in doc}
+        for r in results:
+            if r['id'] in chords:
+                r['chords'] = chords[r['id']]
+
+
+def _code(vocabulary, value):
+    if value is None:
+        return -1
+    if value not in vocabulary:
+        vocabulary.append(value)
+    return vocabulary.index(value)
+
+
+def _float(value):
+    return np.nan if value is None else float(value)
+
+
+def _item(value):
+    value = value.item()
+    return None if isinstance(value, float) and np.isnan(value) else value
+
+
+def _ascending(values, direction):
+    """Map values to floats that sort ascending in the order MongoDB sorts them, with missing values lowest"""
+    values = values.astype(float)
+    if direction == pymongo.DESCENDING:
+        return np.where(np.isnan(values), np.inf, -values)
+    return np.where(np.isnan(values), -np.inf, values)
+
+
+def _top_k(keys, k):
+    """Indices of the k smallest rows in lexicographic order of the keys, with the ties around
+    the k-th row resolved by the remaining keys
+    """
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if k < len(keys[0]):
+        kth = keys[0][np.argpartition(keys[0], k - 1)[:k]].max()
+        candidates = np.flatnonzero(keys[0] <= kth)
+    else:
+        candidates = np.arange(len(keys[0]))
+    order = np.lexsort([key[candidates] for key in reversed(keys)])
+    return candidates[order][:k]
+
+
+def _accurate_sum(values):
+    """Sum along the rows with error compensation, like the double-double summation of MongoDB"""
+    total = np.zeros(len(values))
+    compensation = np.zeros(len(values))
+    for column in values.T:
+        new_total = total + column
+        compensation += np.where(np.abs(total) >= np.abs(column), (total - new_total) + column, (column - new_total) + total)
+        total = new_total
+    return total + compensation
@@ -2,19 +2,35 @@ import os
 import sys
 import json
 import re
+import base64
+import threading
 import requests
 from requests.exceptions import HTTPError
+from concurrent.futures import ThreadPoolExecutor
 import pymongo
 from bson.son import SON
 from urllib.parse import parse_qsl, unquote
+from .column_store import ColumnStore
+from . import similarity
+from . import stored_format
+from . import timing
 
 
 descriptors = ['chords', 'tempo', 'tuning', 'global-key']
 all_providers = ['jamendo-tracks', 'freesound-sounds', 'europeana-res']
 _key_regex = re.compile('^(A#|C#|D#|F#|G#|[A-G])?(major|minor)?$')
-_key_variants = ['edma', 'krumhansl', 'temperley']
 _chord_regex = re.compile('^(Ab|Bb|Db|Eb|Gb|[A-G])(maj|min|7|maj7|min7)$')
+_search_engine = os.getenv('SEARCH_ENGINE', 'mongo')
+_metrics = os.getenv('METRICS', 'true') == 'true'
 _client = None
+_column_store = None
+_similarity_index = None
+_init_lock = threading.RLock()
+# Keep-alive connections to the gateway
+_session = requests.Session()
+# Watchdog variables of the request being handled (Http_Path, Http_Query, ...), set per thread by the
+# long-lived server, or in the process environment by the classic watchdog
+_request = threading.local()
 
 
 def handle(audio_content):
@@ -22,35 +38,74 @@ def handle(audio_content):
     Args:
         req (str): request body
     """
+    timing.start()
     try:
-        query = dict(parse_qsl(unquote(os.getenv('Http_Query', '')), keep_blank_values=True))
-        unknown_descriptors = list(filter(lambda d: d not in descriptors+['providers'], query.keys()))
+        if _request_var('Http_Path', '').lstrip('/') == 'metrics':
+            _set_response_header('Content-Type', 'text/plain; version=0.0.4')
+            return timing.render(timing.totals(_get_db().metrics, 'ac-search'), 'ac_search')
+        query = dict(parse_qsl(unquote(_request_var('Http_Query', '')), keep_blank_values=True))
+        unknown_descriptors = list(filter(lambda d: d not in descriptors+['providers', 'similar'], query.keys()))
         if unknown_descriptors:
             raise HTTPError('Unknown descriptor{} "{}". Allowed descriptors for searching are : "{}"'.format(
             's' if len(unknown_descriptors) > 1 else '', '", "'.join(unknown_descriptors), '", "'.join(descriptors)))
 
-        paging = os.getenv('Http_Path', '').lstrip('/').split('/')
+        paging = _request_var('Http_Path', '').lstrip('/').split('/')
         try:
             num_results = int(paging[0]) if len(paging) > 0 and paging[0] else 1
-            offset = int(paging[1]) if len(paging) > 1 and paging[1] else 0
+            if len(paging) > 1 and paging[1] and not paging[1].isdigit():
+                # keyset pagination, started by "cursor" and continued by the returned token
+                offset = None
+                continuation = paging[1] if paging[1] != 'cursor' else None
+            else:
+                offset = int(paging[1]) if len(paging) > 1 and paging[1] else 0
         except ValueError:
-            raise HTTPError('Invalid paging controls "{}". The correct syntax is "ac-search[/<num-results>[/<offset>]]"'.format(paging))
+            raise HTTPError('Invalid paging controls "{}". The correct syntax is "ac-search[/<num-results>[/<offset>|/cursor|/<continuation-token>]]"'.format(paging))
 
-        if audio_content:
-            query = text_search_params(audio_content, query)
-        return json.dumps(search(query, num_results, offset))
+        if 'similar' in query:
+            if offset is None:
+                raise HTTPError('Similarity search only supports paging by offset')
+            response = similarity_search(audio_content, query, num_results, offset)
+        else:
+            if audio_content:
+                query = text_search_params(audio_content, query)
+            if offset is None:
+                response = search_page(query, num_results, continuation)
+            else:
+                response = search(query, num_results, offset)
+        with timing.stage('serialization'):
+            return json.dumps(response)
     except HTTPError as e:
         return json.dumps(str(e))
+    finally:
+        server_timing = timing.finish('ac-search', (lambda: _get_db().metrics) if _metrics else None)
+        if server_timing:
+            _set_response_header('Server-Timing', server_timing)
+
+def _request_var(name, default=None):
+    return getattr(_request, 'environ', os.environ).get(name, default)
+
+
+def _set_response_header(name, value):
+    # The classic watchdog can't set headers, only the long-lived server can
+    if hasattr(_request, 'headers'):
+        _request.headers[name] = value
+
+
+def warm_up():
+    """Load the column store when it is the search engine, before the long-lived server takes requests"""
+    if _search_engine == 'columns':
+        _get_column_store().refresh()
+
 
 def text_search_params(audio_content, audio_query):
     text_params = {}
+    with timing.stage('analysis'):
+        outputs = _analyse(audio_content, [d for d in audio_query if d != 'providers'])
     for descriptor, audio_params in audio_query.items():
         if descriptor == 'providers':
             text_params[descriptor] = audio_params
         else:
-            descriptor_response = requests.get('http://gateway:8080/function/ac-analysis/{}'.format(descriptor), data=audio_content)
-            descriptor_response.raise_for_status()
-            file_descriptor = descriptor_response.json()
+            file_descriptor = outputs[descriptor]
             if descriptor in ['tempo', 'tuning']:
                 if audio_params == '':
                     text_params[descriptor] = ''
@@ -70,66 +125,248 @@ def text_search_params(audio_content, audio_query):
     return text_params
 
 
+def similarity_search(audio_content, query, num_results, offset):
+    """Search the files most similar to an uploaded audio file, or to the file with the id given as "similar" parameter"""
+    other_descriptors = [d for d in query if d not in ['providers', 'similar']]
+    if other_descriptors:
+        raise HTTPError('Similarity search cannot be combined with searching by "{}"'.format('", "'.join(other_descriptors)))
+    providers = dict(search_conditions(query)).get('providers')
+    with timing.stage('similarity-index'):
+        index = _get_similarity_index()
+    if audio_content:
+        with timing.stage('analysis'):
+            vector = similarity.analysis_features(_analyse(audio_content, similarity.descriptors))
+        exclude = None
+    elif query['similar']:
+        with timing.stage('similarity-index'):
+            vector = index.vector(query['similar'])
+        if vector is None:
+            raise HTTPError('No descriptors found for "{}"'.format(query['similar']))
+        exclude = query['similar']
+    else:
+        raise HTTPError('Similarity search needs either an audio file or the id of a reference file as "similar" parameter')
+    with timing.stage('similarity-search'):
+        results = index.search(vector, num_results, offset, providers, exclude)
+    return [{'id': linked_id, 'distance': distance} for linked_id, distance in results]
+
+
+def _analyse(audio_content, descriptors):
+    """Request several descriptors of an audio file from ac-analysis at once and return their outputs by descriptor"""
+    def analyse(descriptor):
+        descriptor_response = _session.get('http://gateway:8080/function/ac-analysis/{}'.format(descriptor), data=audio_content)
+        descriptor_response.raise_for_status()
+        return descriptor_response.json()
+    if not descriptors:
+        return {}
+    with ThreadPoolExecutor(len(descriptors)) as pool:
+        return dict(zip(descriptors, pool.map(analyse, descriptors)))
+
+
 def search(text_query, num_results, offset):
+    if _search_engine == 'columns':
+        with timing.stage('column-store'):
+            return _decode_stored(_get_column_store().search(search_conditions(text_query), num_results, offset)[0])
+    with timing.stage('query-build'):
+        agg_pipeline, projection = _search_pipeline(text_query)
+        _keyset_sort(agg_pipeline)
+        agg_pipeline.extend([{'$skip': offset}, {'$limit': num_results}])
+        agg_pipeline.append({'$project': projection})
+
+    with timing.stage('db'):
+        results = list(_get_db().descriptors.aggregate(agg_pipeline, allowDiskUse=True))
+    return _decode_stored(results)
+
+
+def search_page(text_query, num_results, continuation=None):
+    """Search with keyset pagination
+
+    Instead of skipping over the results of previous pages, every page starts with a range match
+    on the sort key of the last result of the previous page, encoded in an opaque continuation
+    token. Returns the results and the token for the next page, which is None on the last page.
+
+    Sort keys computed in the pipeline (tempo and tuning distances, key strengths) are also bounded
+    on the indexed fields they are computed from, such that deeper pages leave out the documents of
+    previous pages before computing and sorting. The number of covered chords can't be bounded
+    that way, so pages sorted on it are stable but cost as much as with an offset.
+    """
+    if _search_engine == 'columns':
+        conditions = search_conditions(text_query)
+        sort_keys = ColumnStore.sort_keys(conditions)
+        last_values = _decode_continuation(continuation, sort_keys) if continuation else None
+        with timing.stage('column-store'):
+            results, sort_values = _get_column_store().search(conditions, num_results, after=last_values)
+    else:
+        with timing.stage('query-build'):
+            agg_pipeline, projection = _search_pipeline(text_query)
+            sort_keys = _keyset_sort(agg_pipeline)
+            if continuation:
+                last_values = _decode_continuation(continuation, sort_keys)
+                bound = _keyset_bound(text_query, last_values)
+                if bound is not None:
+                    agg_pipeline.insert(0, {'$match': bound})
+                agg_pipeline.append({'$match': _keyset_match(sort_keys, last_values)})
+            agg_pipeline.append({'$limit': num_results})
+            projection.update({'sort_value_{}'.format(i): '${}'.format(field) for i, (field, _) in enumerate(sort_keys)})
+            agg_pipeline.append({'$project': projection})
+
+        with timing.stage('db'):
+            results = list(_get_db().descriptors.aggregate(agg_pipeline, allowDiskUse=True))
+        sort_values = [[r.pop('sort_value_{}'.format(i), None) for i in range(len(sort_keys))] for r in results]
+    if len(results) == num_results and results:
+        next_continuation = _encode_continuation(sort_keys, sort_values[-1])
+    else:
+        next_continuation = None
+    return {'results': _decode_stored(results), 'next': next_continuation}
+
+
+def _decode_stored(results):
+    """Decode the chord sequences in the results from their compact storage layout"""
+    with timing.stage('decode'):
+        for r in results:
+            if 'chords' in r:
+                r['chords'] = stored_format.decode(r['chords'], _get_db())
+    return results
+
+
+def _search_pipeline(text_query):
     agg_pipeline = []
     projection = {'_id': False, 'id': '$_id'}
 
+    for descriptor, condition in search_conditions(text_query):
+        if descriptor == 'providers':
+            agg_pipeline.append({'$match': {'provider': {'$in': condition}}})
+        elif descriptor in ['tempo', 'tuning']:
+            mongo_field = 'search.{}'.format(descriptor)
+            if condition:
+                agg_pipeline.extend(_number_query_stages(condition, mongo_field))
+            projection[descriptor] = '${}'.format(mongo_field)
+        elif descriptor == 'global-key':
+            if condition:
+                agg_pipeline.extend(_key_query_stages(condition))
+            else:
+                agg_pipeline.append({'$addFields': {'key_best_matching': '$search.key'}})
+            projection['global-key'] = {'key': {'$concat': ['$key_best_matching.key', ' ', '$key_best_matching.scale']}, 
+                                        'confidence': '$key_best_matching.strength'}
+        elif descriptor == 'chords':
+            if condition:
+                agg_pipeline.extend(_chord_query_stages(condition))
+            agg_pipeline.append({'$project': {'chords.distinctChords': False, 'chords.chordRatio': False}})
+            projection['chords'] = True
+    return agg_pipeline, projection
+
+
+def search_conditions(text_query):
+    """Parse and validate a textual query into a list of (descriptor, condition) pairs
+
+    The condition is None for descriptors that are only requested in the output. The order of the
+    list is the order in which the conditions are applied, such that the last condition with a
+    sort order determines the order of the results.
+    """
+    conditions = []
     if 'providers' in text_query:
         allowed_providers = text_query['providers'].split(',')
         unknown_providers = list(filter(lambda p: p not in all_providers, allowed_providers))
         if unknown_providers:
             raise HTTPError('Unknown content provider{} "{}". Allowed content providers are : "{}"'.format(
             's' if len(unknown_providers) > 1 else '', '", "'.join(unknown_providers), '", "'.join(all_providers)))
-        agg_pipeline.append({'$match': {'_id': {'$regex': '^'+'|^'.join(allowed_providers)}}})
-    if 'tempo' in text_query:
-        param = text_query['tempo']
-        if param:
-            agg_pipeline.extend(_parse_single_number_query('tempo', param, 'essentia-music.rhythm.bpm'))
-        projection['tempo'] = '$essentia-music.rhythm.bpm'
-    if 'tuning' in text_query:
-        param = text_query['tuning']
-        if param:
-            agg_pipeline.extend(_parse_single_number_query('tuning', param, 'essentia-music.tonal.tuning_frequency'))
-        projection['tuning'] = '$essentia-music.tonal.tuning_frequency'
+        conditions.append(('providers', allowed_providers))
+    else:
+        # excludes the descriptors of uploaded audio, which are stored under their content hash
+        conditions.append(('providers', all_providers))
+    for descriptor in ['tempo', 'tuning']:
+        if descriptor in text_query:
+            param = text_query[descriptor]
+            conditions.append((descriptor, _parse_single_number_query(descriptor, param) if param else None))
     if 'global-key' in text_query:
         param = text_query['global-key']
-        if param:
-            agg_pipeline.extend(_parse_key_query(param))
-        else:
-            agg_pipeline.append({'$addFields': {'key_best_matching':
-                {'$let': {'vars': {'allKeys': ['$essentia-music.tonal.key_{}'.format(k) for k in _key_variants]},
-                            'in': {'$arrayElemAt': ['$$allKeys', {'$indexOfArray': ['$$allKeys.strength', {'$max': ['$$allKeys.strength']}]}]}}}
-            }})
-        projection['global-key'] = {'key': {'$concat': ['$key_best_matching.key', ' ', '$key_best_matching.scale']}, 
-                                    'confidence': '$key_best_matching.strength'}
+        conditions.append(('global-key', _parse_key_query(param) if param else None))
     if 'chords' in text_query:
         param = text_query['chords']
-        if param:
-            agg_pipeline.extend(_parse_chord_query(param))
-        agg_pipeline.append({'$project': {'chords.distinctChords': False, 'chords.chordRatio': False}})
-        projection['chords'] = True
-    
-    agg_pipeline.extend([{'$skip': offset}, {'$limit': num_results}])
-    agg_pipeline.append({'$project': projection})
+        conditions.append(('chords', _parse_chord_query(param) if param else None))
+    return conditions
+
+
+def _keyset_sort(agg_pipeline):
+    """Make the final sort of a pipeline total by breaking ties on _id, and return its keys"""
+    sort_stages = [i for i, stage in enumerate(agg_pipeline) if '$sort' in stage]
+    if sort_stages:
+        sort_keys = [(f, d) for f, d in agg_pipeline[sort_stages[-1]]['$sort'].items() if f != '_id'] + [('_id', pymongo.ASCENDING)]
+        agg_pipeline[sort_stages[-1]] = {'$sort': SON(sort_keys)}
+    else:
+        sort_keys = [('_id', pymongo.ASCENDING)]
+        agg_pipeline.append({'$sort': SON(sort_keys)})
+    return sort_keys
+
+
+def _keyset_match(sort_keys, last_values):
+    """Match all documents that sort after the given values
+
+    Missing values sort before all others, but are not matched by range comparisons, so they need
+    to be matched explicitly.
+    """
+    alternatives = []
+    for i, (field, direction) in enumerate(sort_keys):
+        equal_before = {f: v for (f, _), v in zip(sort_keys[:i], last_values)}
+        if last_values[i] is None:
+            if direction == pymongo.ASCENDING:
+                alternatives.append(dict(equal_before, **{field: {'$ne': None}}))
+        else:
+            alternatives.append(dict(equal_before, **{field: {'$gt' if direction == pymongo.ASCENDING else '$lt': last_values[i]}}))
+            if direction == pymongo.DESCENDING:
+                alternatives.append(dict(equal_before, **{field: None}))
+    return {'$or': alternatives}
+
+
+def _keyset_bound(text_query, last_values):
+    """Match on indexed search fields that all documents sorting after the given values satisfy
+
+    Returns None when the first sort key is not computed from an indexed field, or can't be bounded.
+    """
+    sorting = [(descriptor, condition) for descriptor, condition in search_conditions(text_query)
+               if descriptor != 'providers' and condition is not None]
+    if not sorting or last_values[0] is None:
+        return None
+    descriptor, condition = sorting[-1]
+    if descriptor in ['tempo', 'tuning'] and condition[0] == 'range':
+        # Later documents are at least as far from the target value, the margin absorbs rounding errors
+        target_value = condition[3]
+        radius = max(last_values[0] - 1e-9 * (1 + abs(target_value)), 0)
+        mongo_field = 'search.{}'.format(descriptor)
+        return {'$or': [{mongo_field: {'$lte': target_value - radius}}, {mongo_field: {'$gte': target_value + radius}}]}
+    elif descriptor == 'global-key':
+        # Later documents have no matching key stronger than the last best matching one
+        tonic, scale = condition
+        key_match = {field: value for field, value in [('key', tonic), ('scale', scale)] if value}
+        return {'search.keys': {'$elemMatch': dict(key_match, strength={'$lte': last_values[0]})}}
+    return None
+
 
-    cursor = _get_db().descriptors.aggregate(agg_pipeline, allowDiskUse=True)
-    return list(cursor)
+def _encode_continuation(sort_keys, last_values):
+    token = json.dumps([[f for f, _ in sort_keys], last_values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(token.encode()).decode().rstrip('=')
 
 
-def _parse_single_number_query(descriptor, param, mongo_field):
+def _decode_continuation(continuation, sort_keys):
+    try:
+        fields, last_values = json.loads(base64.urlsafe_b64decode(continuation + '=' * (-len(continuation) % 4)))
+    except (ValueError, TypeError):
+        raise HTTPError('Invalid continuation token "{}"'.format(continuation))
+    if fields != [f for f, _ in sort_keys] or len(last_values) != len(sort_keys):
+        raise HTTPError('The continuation token "{}" does not belong to this search'.format(continuation))
+    return last_values
+
+
+def _parse_single_number_query(descriptor, param):
+    """Return a condition of the form (operator, value) or ('range', lower, upper, target_value)"""
     try:
         if param.startswith('<='):
-            return [{'$match': {mongo_field: {'$lte': float(param[2:])}}},
-                    {'$sort': {mongo_field: pymongo.DESCENDING}}]
+            return ('$lte', float(param[2:]))
         elif param.startswith('>='):
-            return [{'$match': {mongo_field: {'$gte': float(param[2:])}}},
-                    {'$sort': {mongo_field: pymongo.ASCENDING}}]
+            return ('$gte', float(param[2:]))
         elif param.startswith('<'):
-            return [{'$match': {mongo_field: {'$lt': float(param[1:])}}},
-                    {'$sort': {mongo_field: pymongo.DESCENDING}}]
+            return ('$lt', float(param[1:]))
         elif param.startswith('>'):
-            return [{'$match': {mongo_field: {'$gt': float(param[1:])}}},
-                    {'$sort': {mongo_field: pymongo.ASCENDING}}]
+            return ('$gt', float(param[1:]))
         else:
             if param.endswith('%'):
                 # tolerance
@@ -143,34 +380,46 @@ def _parse_single_number_query(descriptor, param, mongo_field):
                 params = param.split('-')
                 lower, upper = map(float, params)
                 target_value = (lower + upper) / 2
-            return [{'$match': {mongo_field: {'$gte': lower, '$lt': upper}}},
-                    {'$addFields': {'distance': {'$abs': {'$subtract': [target_value, '${}'.format(mongo_field)]}}}},
-                    {'$sort': {'distance': pymongo.ASCENDING}}]
+            return ('range', lower, upper, target_value)
     except (ValueError, IndexError):
         raise HTTPError('The {} search parameters need to be of the form "[<|>|<=|>=]<value>", "<min>-<max>" or "<value>+-<tolerance>%"'.format(descriptor))
 
 
+def _number_query_stages(condition, mongo_field):
+    if condition[0] == 'range':
+        _, lower, upper, target_value = condition
+        return [{'$match': {mongo_field: {'$gte': lower, '$lt': upper}}},
+                {'$addFields': {'distance': {'$abs': {'$subtract': [target_value, '${}'.format(mongo_field)]}}}},
+                {'$sort': {'distance': pymongo.ASCENDING}}]
+    else:
+        operator, value = condition
+        return [{'$match': {mongo_field: {operator: value}}},
+                {'$sort': {mongo_field: pymongo.DESCENDING if operator in ['$lte', '$lt'] else pymongo.ASCENDING}}]
+
+
 def _parse_key_query(param):
+    """Return a condition of the form (tonic, scale), either of which can be None"""
     split_key = _key_regex.match(param)
     try:
-        tonic = split_key.group(1)
-        scale = split_key.group(2)
+        return split_key.group(1), split_key.group(2)
     except AttributeError:
         raise HTTPError('The global-key search parameters need to be of the form [A|A#|B|C|C#|D|D#|E|F|F#|G|G#][major|minor]')
-    match_list = [dict() for k in _key_variants]
+
+
+def _key_query_stages(condition):
+    tonic, scale = condition
+    key_match = {}
     filter_list = []
     if tonic:
-        for m, k in zip(match_list, _key_variants):
-            m['essentia-music.tonal.key_{}.key'.format(k)] = tonic
+        key_match['key'] = tonic
         filter_list.append({'$eq': ['$$this.key', tonic]})
     if scale:
-        for m, k in zip(match_list, _key_variants):
-            m['essentia-music.tonal.key_{}.scale'.format(k)] = scale
+        key_match['scale'] = scale
         filter_list.append({'$eq': ['$$this.scale', scale]})
     return [
-        {'$match': {'$or': match_list}},
+        {'$match': {'search.keys': {'$elemMatch': key_match}}},
         {'$addFields': {'key_best_matching': 
-            {'$let': {'vars': {'matchingKeys': {'$filter': {'input': ['$essentia-music.tonal.key_{}'.format(k) for k in _key_variants], 
+            {'$let': {'vars': {'matchingKeys': {'$filter': {'input': '$search.keys', 
                                                             'cond': {'$and': filter_list}}}},
                     'in': {'$arrayElemAt': ['$$matchingKeys', {'$indexOfArray': ['$$matchingKeys.strength', {'$max': ['$$matchingKeys.strength']}]}]}}}
         }},
@@ -179,6 +428,7 @@ def _parse_key_query(param):
 
 
 def _parse_chord_query(param):
+    """Return a condition of the form (chords, coverage)"""
     params = param.split(',')
     chords = params[0].split('-')
     if not all([_chord_regex.match(c) for c in chords]):
@@ -189,7 +439,12 @@ def _parse_chord_query(param):
             raise HTTPError('The coverage parameter for the chord search needs to be a number between 0 and 100, followed by a percentage sign')
     else:
         coverage = 1.
-    return [
+    return chords, coverage
+
+
+def _chord_query_stages(condition):
+    chords, coverage = condition
+    return ([{'$match': {'search.chords': {'$in': chords}}}] if coverage > 0 else []) + [
         {
             '$addFields':
             {
@@ -208,8 +463,26 @@ def _parse_chord_query(param):
 
 def _get_db():
     global _client
-    if _client is None:
-        sys.stderr.write('Connecting to DB\n')
-        _client = pymongo.MongoClient(os.getenv('MONGO_CONNECTION'))
-    sys.stderr.write('Connected to DB: {}\n'.format(_client))
+    with _init_lock:
+        if _client is None:
+            sys.stderr.write('Connecting to DB\n')
+            _client = pymongo.MongoClient(os.getenv('MONGO_CONNECTION'))
+            sys.stderr.write('Connected to DB: {}\n'.format(_client))
     return _client.ac_analysis_service
+
+
+def _get_column_store():
+    global _column_store
+    with _init_lock:
+        if _column_store is None:
+            _column_store = ColumnStore(_get_db().descriptors, float(os.getenv('COLUMN_STORE_REFRESH_INTERVAL', 10)))
+    return _column_store
+
+
+def _get_similarity_index():
+    global _similarity_index
+    with _init_lock:
+        if _similarity_index is None:
+            _similarity_index = similarity.SimilarityIndex(_get_db().descriptors, float(os.getenv('COLUMN_STORE_REFRESH_INTERVAL', 10)),
+                                                           int(os.getenv('SIMILARITY_LISTS', 0)), int(os.getenv('SIMILARITY_PROBES', 8)))
+    return _similarity_index
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""Long-lived worker serving the handler over HTTP, for of-watchdog in http mode
+
+The classic watchdog forks a process for every request, such that nothing is kept in memory from
+one request to the next. The of-watchdog instead forwards every request to this server, which
+handles it in a thread of the same process. The variables that the classic watchdog sets in the
+environment (Http_Path, Http_Query, ...) are set per thread in handler._request instead, where the
+handler can also set the status and headers of its response.
+
+Every function builds its own image from its own directory, so ac-analysis has a copy of this file.
+"""
+import os
+import sys
+import traceback
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit
+from . import handler
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self._read_body()
+        url = urlsplit(self.path)
+        environ = {'Http_Path': url.path, 'Http_Query': url.query, 'Http_Method': self.command}
+        for name, value in self.headers.items():
+            environ['Http_' + '_'.join(part.capitalize() for part in name.split('-'))] = value
+        handler._request.environ = environ
+        handler._request.status = 200
+        handler._request.headers = {'Content-Type': 'application/json'}
+        try:
+            ret = handler.handle(body)
+            status, headers = handler._request.status, handler._request.headers
+        except Exception:
+            sys.stderr.write('Error handling {} {}\n{}'.format(self.command, self.path, traceback.format_exc()))
+            ret = 'Internal error'
+            status, headers = 500, {'Content-Type': 'text/plain'}
+        finally:
+            del handler._request.environ, handler._request.status, handler._request.headers
+        if ret is None:
+            ret = b''
+        elif isinstance(ret, str):
+            ret = ret.encode()
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(ret)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(ret)
+
+    do_GET = do_POST
+    do_HEAD = do_POST
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return b''.join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+
+if __name__ == '__main__':
+    handler.warm_up()
+    ThreadingHTTPServer(('127.0.0.1', int(os.getenv('port', 5000))), RequestHandler).serve_forever()
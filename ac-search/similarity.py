@@ -0,0 +1,242 @@
+"""Query-by-example similarity search
+
+Every analysed file is represented by a feature vector combining its tempo, tuning, key, chord
+histogram and instrument probabilities. These descriptors have unrelated scales and numbers of
+dimensions, so each of them is weighted such that it has the same total variance over the
+catalogue. The most similar files to an example are its nearest neighbours in Euclidean distance
+between weighted vectors, found by a brute-force scan over the catalogue in batches, or for large
+collections optionally restricted to the nearest lists of an inverted file index.
+"""
+import sys
+import time
+import threading
+from datetime import timedelta
+import numpy as np
+from .column_store import chord_labels
+from .stored_format import decode
+
+
+descriptors = ['tempo', 'tuning', 'global-key', 'chords', 'instruments']
+_chord_index = {label: i for i, label in enumerate(chord_labels)}
+_pitch_classes = {'C': 0, 'C#': 1, 'Db': 1, 'D': 2, 'D#': 3, 'Eb': 3, 'E': 4, 'F': 5, 'F#': 6, 'Gb': 6,
+                  'G': 7, 'G#': 8, 'Ab': 8, 'A': 9, 'A#': 10, 'Bb': 10, 'B': 11}
+_num_instruments = 24
+_key_offset = 2
+_chord_offset = _key_offset + 24
+_instrument_offset = _chord_offset + len(chord_labels)
+num_dimensions = _instrument_offset + _num_instruments
+# Dimensions of every descriptor, which are weighted together
+_descriptor_dimensions = [(0, 1), (1, 2), (_key_offset, _chord_offset), (_chord_offset, _instrument_offset), (_instrument_offset, num_dimensions)]
+_projection = {'provider': True, 'search.tempo': True, 'search.tuning': True, 'search.key': True,
+               'chords.chordRatio': True, 'instruments.annotations.data.value': True, 'updated': True}
+_watermark_overlap = timedelta(seconds=60)
+_batch_size = 65536
+
+
+def feature_vector(tempo=None, tuning=None, key=None, chord_ratio=None, instruments=None):
+    """Combine descriptors into a feature vector
+
+    Args:
+        tempo (float): in beats per minute, compared on a logarithmic scale
+        tuning (float): in Hz, compared in semitones
+        key (tuple): (tonic, scale, strength), one-hot encoded over the 24 keys and weighted by the strength
+        chord_ratio (dict): relative duration of every chord label
+        instruments (list): probabilities of the 24 instruments
+    """
+    vector = np.zeros(num_dimensions, dtype=np.float32)
+    if tempo:
+        vector[0] = np.log2(tempo / 120)
+    if tuning:
+        vector[1] = 12 * np.log2(tuning / 440)
+    if key and key[0] in _pitch_classes:
+        tonic, scale, strength = key
+        vector[_key_offset + _pitch_classes[tonic] + (12 if scale == 'minor' else 0)] = strength
+    if chord_ratio:
+        for label, ratio in chord_ratio.items():
+            if label in _chord_index:
+                vector[_chord_offset + _chord_index[label]] = ratio
+    if instruments:
+        vector[_instrument_offset:] = instruments[:_num_instruments]
+    return vector
+
+
+def document_features(doc):
+    """Feature vector of a document of the descriptors collection"""
+    search = doc.get('search', {})
+    key = search.get('key')
+    try:
+        instruments = decode(doc['instruments']['annotations'][0]['data'][0]['value'])
+    except (KeyError, IndexError):
+        instruments = None
+    return feature_vector(search.get('tempo'), search.get('tuning'),
+                          (key['key'], key['scale'], key['strength']) if key else None,
+                          doc.get('chords', {}).get('chordRatio'), instruments)
+
+
+def analysis_features(outputs):
+    """Feature vector of the ac-analysis outputs of an audio file, given as a dict per descriptor"""
+    tonic, scale = outputs['global-key']['global-key']['key'].split(' ')
+    chord_sequence = outputs['chords']['chords']['chordSequence']
+    chord_ratio = {}
+    for chord in chord_sequence:
+        chord_ratio[chord['label']] = chord_ratio.get(chord['label'], 0) + chord['end'] - chord['start']
+    if chord_sequence:
+        chord_ratio = {label: duration / chord_sequence[-1]['end'] for label, duration in chord_ratio.items()}
+    return feature_vector(outputs['tempo']['tempo'], outputs['tuning']['tuning'],
+                          (tonic, scale, outputs['global-key']['global-key']['confidence']),
+                          chord_ratio, list(outputs['instruments']['instruments'].values()))
+
+
+class SimilarityIndex:
+    """Feature vectors of all descriptor documents, refreshed like the column store
+
+    When num_lists is non-zero and the collection is large enough, the vectors are clustered into
+    that many lists by k-means, and a search only scans the num_probes lists closest to the query,
+    which makes it approximate.
+    """
+    def __init__(self, collection, refresh_interval=10., num_lists=0, num_probes=8):
+        self.collection = collection
+        self.refresh_interval = refresh_interval
+        self.num_lists = num_lists
+        self.num_probes = num_probes
+        self.watermark = None
+        self.last_refresh = None
+        self.lock = threading.Lock()
+        self.providers = []
+        self.ids = np.empty(0, dtype=object)
+        self.rows = {}
+        self.provider = np.empty(0, dtype=np.int16)
+        self.vectors = np.empty((0, num_dimensions), dtype=np.float32)
+        self.norms = np.empty(0, dtype=np.float32)
+        self.weights = np.ones(num_dimensions, dtype=np.float32)
+        self.weighted_size = 0
+        self.centroids = None
+        self.trained_size = 0
+        self.lists = np.empty(0, dtype=np.int32)
+
+    def refresh(self, force=False):
+        """Load all documents updated since the previous refresh, if it is older than the refresh interval"""
+        with self.lock:
+            if not force and self.last_refresh is not None and time.monotonic() - self.last_refresh < self.refresh_interval:
+                return
+            start = time.monotonic()
+            if self.watermark is None:
+                cursor = self.collection.find({}, _projection)
+            else:
+                cursor = self.collection.find({'updated': {'$gte': self.watermark - _watermark_overlap}}, _projection)
+            num_docs = self._load(cursor)
+            reweighted = len(self.ids) > 0 and len(self.ids) >= 2 * self.weighted_size
+            if reweighted:
+                self._fit_weights()
+            if self.num_lists and (len(self.ids) >= 2 * max(self.trained_size, 40 * self.num_lists) or (reweighted and self.centroids is not None)):
+                self._train()
+            self.last_refresh = time.monotonic()
+            sys.stderr.write('Loaded {} documents into similarity index in {:.3f}s\n'.format(num_docs, self.last_refresh - start))
+
+    def _load(self, docs):
+        new_ids = []
+        new_rows = []
+        num_updated = 0
+        for doc in docs:
+            if doc.get('updated') is not None and (self.watermark is None or doc['updated'] > self.watermark):
+                self.watermark = doc['updated']
+            vector = document_features(doc) * self.weights
+            if doc.get('provider') not in self.providers:
+                self.providers.append(doc.get('provider'))
+            provider = self.providers.index(doc.get('provider'))
+            if doc['_id'] in self.rows:
+                row = self.rows[doc['_id']]
+                self.vectors[row] = vector
+                self.norms[row] = vector @ vector
+                self.provider[row] = provider
+                if self.centroids is not None:
+                    self.lists[row] = self._nearest_lists(vector[np.newaxis], 1)[0, 0]
+                num_updated += 1
+            else:
+                new_ids.append(doc['_id'])
+                new_rows.append((provider, vector))
+        if new_rows:
+            first_row = len(self.ids)
+            vectors = np.array([v for _, v in new_rows], dtype=np.float32)
+            self.ids = np.concatenate((self.ids, np.array(new_ids, dtype=object)))
+            self.rows.update({linked_id: first_row + i for i, linked_id in enumerate(new_ids)})
+            self.provider = np.concatenate((self.provider, np.array([p for p, _ in new_rows], dtype=np.int16)))
+            self.vectors = np.concatenate((self.vectors, vectors))
+            self.norms = np.concatenate((self.norms, np.einsum('ij,ij->i', vectors, vectors)))
+            if self.centroids is not None:
+                self.lists = np.concatenate((self.lists, self._nearest_lists(vectors, 1)[:, 0]))
+        return num_updated + len(new_rows)
+
+    def _fit_weights(self, sample_size=65536):
+        """Weight every descriptor by the inverse of its standard deviation over a sample of the catalogue"""
+        rng = np.random.default_rng(0)
+        sample = self.vectors[rng.choice(len(self.vectors), min(len(self.vectors), sample_size), replace=False)] / self.weights
+        weights = np.ones(num_dimensions, dtype=np.float32)
+        for start, end in _descriptor_dimensions:
+            variance = sample[:, start:end].var(axis=0).sum()
+            if variance > 0:
+                weights[start:end] = 1 / np.sqrt(variance)
+        for start in range(0, len(self.vectors), _batch_size):
+            self.vectors[start:start + _batch_size] *= weights / self.weights
+        self.norms = np.einsum('ij,ij->i', self.vectors, self.vectors)
+        self.weights = weights
+        self.weighted_size = len(self.vectors)
+        sys.stderr.write('Fitted descriptor weights {} on {} vectors\n'.format(
+            ', '.join('{:.3g}'.format(weights[start]) for start, _ in _descriptor_dimensions), len(sample)))
+
+    def _train(self, num_iterations=10):
+        """Cluster a sample of the vectors into lists with k-means"""
+        rng = np.random.default_rng(0)
+        sample = self.vectors[rng.choice(len(self.vectors), min(len(self.vectors), 256 * self.num_lists), replace=False)]
+        self.centroids = sample[rng.choice(len(sample), self.num_lists, replace=False)].copy()
+        for _ in range(num_iterations):
+            assignment = self._nearest_lists(sample, 1)[:, 0]
+            for i in range(self.num_lists):
+                members = sample[assignment == i]
+                if len(members):
+                    self.centroids[i] = members.mean(axis=0)
+        self.lists = np.concatenate([self._nearest_lists(self.vectors[start:start + _batch_size], 1)[:, 0]
+                                     for start in range(0, len(self.vectors), _batch_size)])
+        self.trained_size = len(self.vectors)
+        sys.stderr.write('Trained {} lists on {} vectors\n'.format(self.num_lists, len(sample)))
+
+    def _nearest_lists(self, vectors, num_lists):
+        distances = (self.centroids ** 2).sum(axis=1) - 2 * vectors @ self.centroids.T
+        return np.argsort(distances, axis=1)[:, :num_lists]
+
+    def vector(self, linked_id):
+        """Feature vector of a document, before weighting"""
+        self.refresh()
+        with self.lock:
+            row = self.rows.get(linked_id)
+            return None if row is None else self.vectors[row] / self.weights
+
+    def search(self, query, num_results, offset=0, providers=None, exclude=None):
+        """Return the (id, distance) pairs of the vectors nearest to the query feature vector, by weighted distance"""
+        self.refresh()
+        # Refreshes replace and resize the arrays, so they are only read under the lock
+        with self.lock:
+            query = np.asarray(query, dtype=np.float32) * self.weights
+            k = num_results + offset
+            if self.centroids is not None:
+                candidates = np.flatnonzero(np.isin(self.lists, self._nearest_lists(query[np.newaxis], self.num_probes)[0]))
+            else:
+                candidates = np.arange(len(self.ids))
+            if providers is not None:
+                candidates = candidates[np.isin(self.provider[candidates], [self.providers.index(p) for p in providers if p in self.providers])]
+            if exclude is not None and exclude in self.rows:
+                candidates = candidates[candidates != self.rows[exclude]]
+
+            best_rows = np.empty(0, dtype=np.int64)
+            best_distances = np.empty(0, dtype=np.float32)
+            for start in range(0, len(candidates), _batch_size):
+                rows = candidates[start:start + _batch_size]
+                distances = self.norms[rows] - 2 * self.vectors[rows] @ query + query @ query
+                rows = np.concatenate((best_rows, rows))
+                distances = np.concatenate((best_distances, distances))
+                if len(rows) > k:
+                    nearest = np.argpartition(distances, k - 1)[:k]
+                    rows, distances = rows[nearest], distances[nearest]
+                best_rows, best_distances = rows, distances
+            order = np.argsort(best_distances, kind='stable')[offset:k]
+            return [(self.ids[row], float(np.sqrt(max(distance, 0)))) for row, distance in zip(best_rows[order], best_distances[order])]
@@ -0,0 +1,28 @@
+"""Reading of descriptor results in the compact storage layout written by ac-analysis
+
+See ac-analysis/stored_format.py for the layout, documents stored before it are read as they are.
+"""
+import bson
+import gridfs
+import numpy as np
+
+
+gridfs_collection = 'results'
+
+
+def decode(value, db=None):
+    """Decode a descriptor result from the compact layout, reading references from the GridFS of db"""
+    if isinstance(value, dict):
+        if '_packed' in value:
+            return np.frombuffer(value['data'], dtype=value['_packed']).tolist()
+        elif '_coded' in value:
+            return [value['dictionary'][c] for c in np.frombuffer(value['data'], dtype=value['_coded']).tolist()]
+        elif '_columns' in value:
+            columns = {k: decode(v, db) for k, v in value['_columns'].items()}
+            return [dict(zip(columns, row)) for row in zip(*columns.values())] if columns else [{}] * value['length']
+        elif '_gridfs' in value:
+            return decode(bson.decode(gridfs.GridFS(db, gridfs_collection).get(value['_gridfs']).read())['value'], db)
+        return {k: decode(v, db) for k, v in value.items()}
+    elif isinstance(value, list):
+        return [decode(v, db) for v in value]
+    return value
@@ -0,0 +1,185 @@
+"""Per-stage timings and cache counters of requests
+
+A request is timed from start() to finish() in the thread handling it. Its stages are timed with
+`with stage('db'):`, and its cache lookups are counted with count('response-cache', hit). Functions
+that a pool runs on behalf of the request are wrapped with bind(), such that their stages count towards
+the request. The time of a stage is that of the union of its intervals, so a stage running in several
+threads at once never takes longer than the request.
+
+finish() returns the timings of the request as the value of a Server-Timing header, and adds them to
+totals that are kept in memory and added to the metrics collection every METRICS_FLUSH_INTERVAL seconds,
+in a document per replica. render() formats the sum of those documents for Prometheus, with a histogram
+of the time spent in every stage per request.
+
+Every function builds its own image from its own directory, so ac-analysis has a copy of this file.
+"""
+import os
+import sys
+import time
+import atexit
+import bisect
+import socket
+import threading
+import contextlib
+import pymongo
+from collections import defaultdict, Counter
+
+
+# Upper bounds in seconds of the histogram buckets
+buckets = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+_flush_interval = float(os.getenv('METRICS_FLUSH_INTERVAL', 10))
+# Recorder of the request handled by the current thread
+_current = threading.local()
+# Increments of the totals not added to the metrics collection yet
+_increments = Counter()
+_last_flush = 0
+_flush_at_exit = False
+_lock = threading.Lock()
+
+
+class _Recorder:
+    def __init__(self):
+        self.intervals = defaultdict(list)
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    def durations(self):
+        """Total time of every stage, counting the time during which several of its intervals overlap once"""
+        durations = {}
+        for name, intervals in self.intervals.items():
+            total = 0
+            end = float('-inf')
+            for interval_start, interval_end in sorted(intervals):
+                total += max(interval_end - max(interval_start, end), 0)
+                end = max(end, interval_end)
+            durations[name] = total
+        return durations
+
+
+def start():
+    """Start timing the request handled by the current thread"""
+    _current.recorder = _Recorder()
+
+
+def bind(function):
+    """Wrap a function run by another thread, such that its stages count towards the current request"""
+    recorder = getattr(_current, 'recorder', None)
+
+    def bound(*args, **kwargs):
+        previous = getattr(_current, 'recorder', None)
+        _current.recorder = recorder
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _current.recorder = previous
+    return bound
+
+
+@contextlib.contextmanager
+def stage(name):
+    recorder = getattr(_current, 'recorder', None)
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        if recorder is not None:
+            with recorder.lock:
+                recorder.intervals[name].append((start_time, time.perf_counter()))
+
+
+def count(cache, hit):
+    recorder = getattr(_current, 'recorder', None)
+    if recorder is not None:
+        with recorder.lock:
+            recorder.counts[(cache, 'hit' if hit else 'miss')] += 1
+
+
+def finish(function, metrics_collection=None):
+    """Log the timings of the current request, add them to the totals of a function and return them
+
+    Args:
+        function (str): name of the function under which the totals are kept
+        metrics_collection (callable): returns the collection of the totals, or None to only log
+
+    Returns:
+        str: the timings formatted as a Server-Timing header value, empty without any
+    """
+    global _flush_at_exit
+    recorder = getattr(_current, 'recorder', None)
+    _current.recorder = None
+    if recorder is None:
+        return ''
+    with recorder.lock:
+        durations, counts = recorder.durations(), dict(recorder.counts)
+    timings = ', '.join('{};dur={:.1f}'.format(name, 1000 * duration) for name, duration in durations.items())
+    if timings:
+        sys.stderr.write('Server-Timing: {}\n'.format(timings))
+    if metrics_collection is None or (not durations and not counts):
+        return timings
+    with _lock:
+        if not _flush_at_exit:
+            atexit.register(flush, function, metrics_collection)
+            _flush_at_exit = True
+        _increments['requests'] += 1
+        for name, duration in durations.items():
+            _increments['stages.{}.count'.format(name)] += 1
+            _increments['stages.{}.sum'.format(name)] += duration
+            _increments['stages.{}.buckets.{}'.format(name, bisect.bisect_left(buckets, duration))] += 1
+        for (cache, result), n in counts.items():
+            _increments['caches.{}.{}'.format(cache, result)] += n
+    if time.monotonic() - _last_flush >= _flush_interval:
+        flush(function, metrics_collection)
+    return timings
+
+
+def flush(function, metrics_collection):
+    """Add the totals kept in memory to the document of this replica in the metrics collection"""
+    global _last_flush
+    with _lock:
+        increments = dict(_increments)
+        _increments.clear()
+        _last_flush = time.monotonic()
+    if not increments:
+        return
+    try:
+        metrics_collection().update_one({'_id': '{}:{}'.format(function, socket.gethostname())},
+                                        {'$set': {'function': function}, '$inc': increments}, upsert=True)
+    except pymongo.errors.PyMongoError as e:
+        sys.stderr.write('Could not store metrics: {}\n'.format(e))
+        with _lock:
+            _increments.update(increments)
+
+
+def totals(metrics_collection, function):
+    """Sum of the totals of a function over all replicas, including those stored under the name of the function alone"""
+    summed = {}
+    for doc in metrics_collection.find({'$or': [{'_id': function}, {'function': function}]}, {'_id': False, 'function': False}):
+        _add(summed, doc)
+    return summed
+
+
+def _add(summed, totals):
+    for key, value in totals.items():
+        if isinstance(value, dict):
+            _add(summed.setdefault(key, {}), value)
+        else:
+            summed[key] = summed.get(key, 0) + value
+
+
+def render(totals, prefix):
+    """Format the totals of a function in the Prometheus text format"""
+    lines = ['# TYPE {}_requests_total counter'.format(prefix),
+             '{}_requests_total {}'.format(prefix, totals.get('requests', 0)),
+             '# TYPE {}_stage_duration_seconds histogram'.format(prefix)]
+    for name, stage_totals in sorted(totals.get('stages', {}).items()):
+        cumulative = 0
+        for i, bound in enumerate(buckets + ['+Inf']):
+            cumulative += stage_totals.get('buckets', {}).get(str(i), 0)
+            lines.append('{}_stage_duration_seconds_bucket{{stage="{}",le="{}"}} {}'.format(prefix, name, bound, cumulative))
+        lines.append('{}_stage_duration_seconds_sum{{stage="{}"}} {}'.format(prefix, name, stage_totals['sum']))
+        lines.append('{}_stage_duration_seconds_count{{stage="{}"}} {}'.format(prefix, name, stage_totals['count']))
+    lines.append('# TYPE {}_cache_lookups_total counter'.format(prefix))
+    for cache, results in sorted(totals.get('caches', {}).items()):
+        for result, n in sorted(results.items()):
+            lines.append('{}_cache_lookups_total{{cache="{}",result="{}"}} {}'.format(prefix, cache, result, n))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""Compare the per-request latency of the confident-chord-estimator in cold and warm mode
+
+Cold mode starts a new process for every request, like the classic watchdog does, such that
+madmom and the chord model are loaded every time. Warm mode sends all requests to a single
+long-lived worker. Needs the dependencies of the chord estimator to be installed.
+
+    python3 benchmarks/chord_estimator_latency.py some-audio.wav --repeats 10
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+import statistics
+import urllib.error
+import urllib.request
+
+estimator_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'confident-chord-estimator')
+
+
+def cold_request(audio_content, audio_name):
+    # The handler writes the audio to Http_Path relative to its working directory
+    with tempfile.TemporaryDirectory() as working_dir:
+        subprocess.run([sys.executable, os.path.join(estimator_dir, 'index.py')], input=audio_content, cwd=working_dir,
+                       env=dict(os.environ, Http_Path=audio_name), stdout=subprocess.DEVNULL, check=True)
+
+
+def warm_request(audio_content, audio_name, port):
+    request = urllib.request.Request('http://127.0.0.1:{}/{}'.format(port, audio_name), data=audio_content, method='POST')
+    with urllib.request.urlopen(request) as response:
+        response.read()
+
+
+def wait_for_worker(port, timeout=120):
+    start = time.monotonic()
+    while time.monotonic() - start < timeout:
+        try:
+            urllib.request.urlopen('http://127.0.0.1:{}/'.format(port), timeout=1)
+        except urllib.error.HTTPError:
+            return
+        except OSError:
+            time.sleep(0.5)
+    raise RuntimeError('Worker did not start within {}s'.format(timeout))
+
+
+def report(name, durations):
+    print('{:<6} mean {:8.3f}s  median {:8.3f}s  min {:8.3f}s  max {:8.3f}s'.format(
+        name, statistics.mean(durations), statistics.median(durations), min(durations), max(durations)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('audio_file')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--port', type=int, default=5000)
+    args = parser.parse_args()
+    with open(args.audio_file, 'rb') as f:
+        audio_content = f.read()
+    audio_name = os.path.basename(args.audio_file)
+
+    durations = []
+    for _ in range(args.repeats):
+        start = time.perf_counter()
+        cold_request(audio_content, audio_name)
+        durations.append(time.perf_counter() - start)
+    report('cold', durations)
+
+    worker = subprocess.Popen([sys.executable, 'index.py', '--serve'], cwd=estimator_dir,
+                              env=dict(os.environ, port=str(args.port)), stderr=subprocess.DEVNULL)
+    try:
+        wait_for_worker(args.port)
+        durations = []
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            warm_request(audio_content, audio_name, args.port)
+            durations.append(time.perf_counter() - start)
+        report('warm', durations)
+    finally:
+        worker.terminate()
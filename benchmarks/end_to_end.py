@@ -0,0 +1,429 @@
+#!/usr/bin/env python3
+"""End-to-end benchmarks of the request paths of ac-analysis and ac-search
+
+Runs the handle functions the way the watchdog does, against local stand-ins: a stub gateway
+serving canned essentia, JAMS and chord outputs after configurable delays, as well as the audio
+files; the MongoDB server given by MONGO_CONNECTION, or mongomock without one; and with --minio the
+local MinIO server given by MINIO_HOSTNAME, MINIO_ACCESS_KEY and MINIO_SECRET_KEY as audio cache.
+Reports the p50/p95/p99 latency and the throughput of these scenarios:
+
+    analysis/cold-miss/*    descriptors calculated through the gateway and stored
+    analysis/db-hit/*       descriptors read from the DB, with the response cache disabled
+    analysis/cache-hit/*    rendered responses served from the response cache
+    analysis/json-ld/*      descriptors read from the DB and converted to JSON-LD, with an error
+                            when the JSON-LD lacks the id or an interval per segment of the result
+    backfill/*              the backfill tool over --backfill-ids ids, of which a quarter already
+                            have their descriptors stored, reporting the wall time per id as latency
+                            and every id left without all its descriptors as an error
+    search/<num-docs>/*     every type of search query, over a synthetic collection of that size
+
+The results are stored as JSON in --results-dir, and compared with an earlier run with --compare. The
+exit status is 1 if any scenario had errors, so that `--only backfill` checks that a backfill runs to
+completion and stores every descriptor.
+
+    MONGO_CONNECTION=mongodb://localhost:27017 python3 benchmarks/end_to_end.py --sizes 10000 100000 1000000
+    python3 benchmarks/end_to_end.py --sizes 10000 --compare benchmarks/results/end_to_end-20240101T120000.json
+"""
+import io
+import os
+import sys
+import json
+import time
+import wave
+import types
+import random
+import argparse
+import tempfile
+import threading
+import contextlib
+import subprocess
+import importlib
+import importlib.util
+import multiprocessing
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+import numpy as np
+import pymongo
+
+benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(benchmarks_dir)
+sys.path.insert(0, benchmarks_dir)
+import search_engines
+
+
+analysis_descriptors = ['chords', 'tempo', 'global-key', 'keys', 'beats-beatroot', 'instruments']
+json_ld_descriptors = ['chords', 'beats-beatroot']
+search_queries = {
+    'tempo-range': ('/10', 'tempo=118-122'),
+    'tempo-bound': ('/10', 'tempo=>150'),
+    'tempo-tolerance': ('/10', 'tempo=120 -2%&tuning='),
+    'tuning': ('/10', 'tuning=>=445'),
+    'key': ('/10', 'global-key=Aminor'),
+    'key-providers': ('/10', 'global-key=major&providers=freesound-sounds,europeana-res'),
+    'sort-only': ('/10', 'global-key=&tempo='),
+    'chords': ('/10', 'chords=Cmaj-Amin-Fmaj-Gmaj,80%'),
+    'chords-tempo': ('/10', 'chords=Dmin,20%&tempo=100-140'),
+    'offset-page': ('/10/1000', 'tempo=>100'),
+    'cursor-page': ('/10/cursor', 'tempo=>100'),
+    'similar': ('/10', 'similar={similar_id}'),
+}
+_instrument_count = 24
+
+
+class StubGateway(ThreadingHTTPServer):
+    """Serves canned outputs of the backend functions after a delay, and the audio of every id"""
+    daemon_threads = True
+
+    def __init__(self, port, delays, sequence_length):
+        super().__init__(('127.0.0.1', port), _StubGatewayHandler)
+        self.delays = delays
+        self.sequence_length = sequence_length
+        self.audio = _sine_wav(1.0)
+
+    def output(self, function, params):
+        rng = random.Random(0)
+        if function == 'essentia':
+            tonal = {'tuning_frequency': 440.0}
+            for variant in ['edma', 'krumhansl', 'temperley']:
+                tonal['key_' + variant] = {'key': rng.choice(['A', 'C', 'E']), 'scale': rng.choice(['major', 'minor']), 'strength': rng.random()}
+            return {'rhythm': {'bpm': 120.0, 'beats_position': [0.5 * i for i in range(self.sequence_length)]}, 'tonal': tonal}
+        elif function == 'confident-chord-estimator':
+            labels = [rng.choice(['Cmaj', 'Amin', 'Fmaj', 'Gmaj', 'Dmin']) for _ in range(self.sequence_length)]
+            return {'confidence': 0.8, 'duration': self.sequence_length * 0.5, 'distinctChords': len(set(labels)),
+                    'chordRatio': {label: labels.count(label) / len(labels) for label in set(labels)},
+                    'chordSequence': [{'start': i * 0.5, 'end': (i + 1) * 0.5, 'label': label} for i, label in enumerate(labels)]}
+        elif function == 'instrument-identifier':
+            annotations = [_jams_annotation('instrument-probabilities', 'probabilities', [{'time': 0.0, 'duration': 0.0, 'confidence': None,
+                           'value': [rng.random() for _ in range(_instrument_count)]}])]
+        else:
+            annotations = []
+            for transform in params.get('-t', []):
+                if transform.endswith('/keys.n3'):
+                    annotations.append(_jams_annotation('qm-keydetector', 'key', [{'time': i * 10.0, 'duration': 10.0, 'value': 1.0, 'label': 'C major'}
+                                                                                 for i in range(self.sequence_length // 20 + 1)]))
+                elif transform.endswith('/beats-beatroot.n3'):
+                    annotations.append(_jams_annotation('beatroot', 'beats', [{'time': i * 0.5, 'duration': 0.0, 'value': None, 'confidence': None}
+                                                                              for i in range(self.sequence_length)]))
+        return {'file_metadata': {'duration': self.sequence_length * 0.5}, 'annotations': annotations}
+
+
+class _StubGatewayHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        parts = url.path.split('/')
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if parts[1] == 'audio':
+            self._respond(200, self.server.audio, 'audio/wav')
+        elif parts[1] == 'function':
+            time.sleep(self.server.delays.get(parts[2], 0))
+            self._respond(200, json.dumps(self.server.output(parts[2], parse_qs(url.query, keep_blank_values=True))).encode(), 'application/json')
+        elif parts[1] == 'async-function':
+            self._respond(202, b'', 'text/plain')
+        else:
+            self._respond(404, b'', 'text/plain')
+
+    do_POST = do_GET
+
+    def _respond(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def _jams_annotation(plugin, output, data):
+    return {'namespace': output, 'annotation_metadata': {'annotator': {'transform_id': 'vamp:qm-vamp-plugins:{}:{}'.format(plugin, output)}},
+            'data': data}
+
+
+def _sine_wav(duration, samplerate=44100):
+    samples = (8192 * np.sin(2 * np.pi * 440 * np.arange(int(duration * samplerate)) / samplerate)).astype('<i2')
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(samplerate)
+        w.writeframes(samples.tobytes())
+    return buffer.getvalue()
+
+
+def load_package(name, directory):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(repo_dir, directory, '__init__.py'),
+                                                  submodule_search_locations=[os.path.join(repo_dir, directory)])
+    sys.modules[name] = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(sys.modules[name])
+
+
+def load_analysis(gateway_url, minio):
+    """Import the ac-analysis handler, downloading audio from the stub gateway or through MinIO"""
+    load_package('ac_analysis', 'ac-analysis')
+    if minio:
+        sys.modules['ac_analysis.config'] = importlib.import_module('ac_analysis.config_cached_audio')
+    else:
+        config = types.ModuleType('ac_analysis.config')
+        config.providers = search_engines._providers
+        config.audio_uri = lambda provider_id, provider: '{}/audio/{}/{}.wav'.format(gateway_url, provider, provider_id)
+        sys.modules['ac_analysis.config'] = config
+    return importlib.import_module('ac_analysis.handler')
+
+
+def upload_audio(config, linked_ids, audio):
+    """Put the audio of ids into the MinIO buckets where the audio cache of ac-analysis looks for it"""
+    for linked_id in linked_ids:
+        provider, provider_id = linked_id.split(':')
+        if not config._client.bucket_exists(provider):
+            config._client.make_bucket(provider)
+        object_prefix = provider_id[-2:] + '/' + provider_id if provider in ['jamendo-tracks', 'freesound-sounds'] else provider_id
+        config._client.put_object(provider, object_prefix + '.wav', io.BytesIO(audio), len(audio), 'audio/wav')
+
+
+def fill(db, num_docs, batch_size=10000):
+    """Fill the descriptors collection with synthetic documents, including instruments for similarity search"""
+    db.descriptors.drop()
+    rng = random.Random(0)
+    for start in range(0, num_docs, batch_size):
+        docs = [search_engines.synthetic_document(rng, i) for i in range(start, min(start + batch_size, num_docs))]
+        for doc in docs:
+            doc['instruments'] = {'annotations': [{'data': [{'value': [rng.random() for _ in range(_instrument_count)]}]}]}
+        db.descriptors.insert_many(docs, ordered=False)
+    search_engines.search_fields.create_indexes(db)
+
+
+def request(handler, path, query, content_type=None):
+    """Call handle with the environment the watchdog sets, and return the duration and whether the response is an error"""
+    os.environ['Http_Path'] = path
+    os.environ['Http_Query'] = query
+    os.environ['Http_Method'] = 'GET'
+    if content_type:
+        os.environ['Http_Content_Type'] = content_type
+    else:
+        os.environ.pop('Http_Content_Type', None)
+    start = time.perf_counter()
+    try:
+        response = handler.handle(b'')
+    except Exception as e:
+        # The watchdog answers 500 to requests that raise
+        sys.stderr.write('{}?{} raised {!r}\n'.format(path, query, e))
+        return time.perf_counter() - start, True
+    duration = time.perf_counter() - start
+    # Errors are returned as a JSON string
+    return duration, isinstance(response, str) and response.startswith('"')
+
+
+def json_ld_complete(handler, descriptor, linked_id, sequence_length):
+    """Whether the JSON-LD of a descriptor describes the id, with an interval per segment of the stub output"""
+    os.environ.update(Http_Path='/' + descriptor, Http_Query='id=' + linked_id, Http_Method='GET', Http_Content_Type='application/ld+json')
+    try:
+        graph = json.loads(handler.handle(b''))['@graph']
+    except Exception as e:
+        sys.stderr.write('No JSON-LD for "{}": {!r}\n'.format(descriptor, e))
+        return False
+    intervals = [node for node in graph if node['@type'] == 'timeline:Interval']
+    return any(node['@id'].endswith(linked_id) for node in graph) and len(intervals) == sequence_length
+
+
+_worker_handler = None
+
+
+def _init_worker(handler, connect):
+    global _worker_handler
+    _worker_handler = handler
+    # MongoDB clients can't be shared with forked processes
+    db = connect()
+    handler._get_db = lambda: db
+
+
+def _worker_request(args):
+    return request(_worker_handler, *args)
+
+
+def run_scenario(handler, requests, concurrency, connect):
+    """Send requests of the form (path, query, content-type) and return their latency statistics"""
+    start = time.perf_counter()
+    if concurrency > 1:
+        with multiprocessing.get_context('fork').Pool(concurrency, _init_worker, (handler, connect)) as pool:
+            outcomes = pool.map(_worker_request, requests, chunksize=1)
+    else:
+        outcomes = [request(handler, *r) for r in requests]
+    wall_time = time.perf_counter() - start
+    durations = np.array([d for d, _ in outcomes])
+    return {'requests': len(requests), 'errors': sum(e for _, e in outcomes), 'throughput': len(requests) / wall_time,
+            'mean': durations.mean(), 'p50': np.percentile(durations, 50), 'p95': np.percentile(durations, 95), 'p99': np.percentile(durations, 99)}
+
+
+def analysis_scenarios(handler, db, args, connect):
+    for collection in ['descriptors', 'leases', 'jobs', 'backend_health', 'rendered_responses']:
+        db[collection].drop()
+    linked_ids = ['{}:{}'.format(search_engines._providers[i % 3], 9000000 + i) for i in range(args.requests)]
+    if args.minio:
+        upload_audio(sys.modules['ac_analysis.config'], linked_ids, _sine_wav(1.0))
+    cache = handler._response_cache
+    handler._response_cache = handler.ResponseCache(0, 0)
+    for descriptor in analysis_descriptors:
+        requests = [('/' + descriptor, 'id=' + i) for i in linked_ids]
+        # Descriptors computed together, by essentia or by a single sonic-annotator call, are only cold for the first of them
+        if descriptor not in ['global-key', 'beats-beatroot']:
+            yield 'analysis/cold-miss/' + descriptor, run_scenario(handler, requests, args.concurrency, connect)
+        yield 'analysis/db-hit/' + descriptor, run_scenario(handler, requests, args.concurrency, connect)
+    for descriptor in json_ld_descriptors:
+        requests = [('/' + descriptor, 'id=' + i, 'application/ld+json') for i in linked_ids]
+        stats = run_scenario(handler, requests, args.concurrency, connect)
+        if not json_ld_complete(handler, descriptor, linked_ids[0], args.sequence_length):
+            sys.stderr.write('The JSON-LD of "{}" lacks the id or segments of the result\n'.format(descriptor))
+            stats['errors'] += 1
+        yield 'analysis/json-ld/' + descriptor, stats
+    handler._response_cache = cache
+    for descriptor in ['chords', 'tempo']:
+        requests = [('/' + descriptor, 'id=' + i) for i in linked_ids]
+        run_scenario(handler, requests, 1, connect)
+        # The response cache is per process
+        yield 'analysis/cache-hit/' + descriptor, run_scenario(handler, requests, 1, connect)
+
+
+def backfill_scenarios(handler, db, args):
+    for collection in ['descriptors', 'leases']:
+        db[collection].drop()
+    backfill = importlib.import_module('ac_analysis.backfill')
+    req_descriptors = list(dict.fromkeys(map(handler._requested_descriptor, analysis_descriptors)))
+    linked_ids = ['{}:{}'.format(search_engines._providers[i % 3], 8000000 + i) for i in range(args.backfill_ids)]
+    if args.minio:
+        upload_audio(sys.modules['ac_analysis.config'], linked_ids, _sine_wav(1.0))
+    # Stored descriptors are skipped, without their calculations
+    db.descriptors.insert_many([{'_id': i, 'essentia-music': {}, 'chords': {}} for i in linked_ids[::4]])
+    with tempfile.TemporaryDirectory() as directory:
+        ids_path = os.path.join(directory, 'ids.txt')
+        with open(ids_path, 'w') as f:
+            f.write(''.join(i + '\n' for i in linked_ids))
+        limits = {b: 4 for b in set(handler.backend_functions.values())}
+        run = backfill.Backfill(req_descriptors, limits, 8, 2 * (8 + 4 * len(limits)), 50, 1, os.path.join(directory, 'ids.checkpoint'),
+                                os.path.join(directory, 'ids.failures'))
+        start = time.perf_counter()
+        counts = run.run(ids_path)
+        wall_time = time.perf_counter() - start
+    incomplete = db.descriptors.count_documents({'_id': {'$in': linked_ids}, '$or': [{d: {'$exists': False}} for d in req_descriptors]})
+    if db.leases.count_documents({}) or counts['ids'] != len(linked_ids):
+        sys.stderr.write('Backfill left {} leases, and finished {} of {} ids\n'.format(db.leases.count_documents({}), counts['ids'], len(linked_ids)))
+        incomplete = max(incomplete, 1)
+    per_id = wall_time / len(linked_ids)
+    yield 'backfill/' + '+'.join(req_descriptors), {'requests': len(linked_ids), 'errors': incomplete, 'throughput': len(linked_ids) / wall_time,
+                                                    'mean': per_id, 'p50': per_id, 'p95': per_id, 'p99': per_id}
+
+
+def search_scenarios(handler, db, args, connect):
+    for num_docs in args.sizes:
+        start = time.perf_counter()
+        fill(db, num_docs)
+        print('Inserted {} documents in {:.1f} s'.format(num_docs, time.perf_counter() - start), file=sys.__stderr__)
+        handler._column_store = None
+        handler._similarity_index = None
+        similar_id = db.descriptors.find_one({}, {'_id': True})['_id']
+        for name, (path, query) in search_queries.items():
+            requests = [(path, query.format(similar_id=similar_id))] * args.search_requests
+            # Warm up the column store and similarity index once
+            request(handler, *requests[0])
+            yield 'search/{}/{}'.format(num_docs, name), run_scenario(handler, requests, args.concurrency, connect)
+
+
+def compare(results, baseline, threshold):
+    """Print the latency ratios with a baseline and return the number of regressions"""
+    regressions = 0
+    print('\n{:<44} {:>10} {:>10} {:>10}'.format('compared with ' + baseline['date'], 'p50', 'p95', 'p99'))
+    for name, stats in results['scenarios'].items():
+        if name not in baseline['scenarios']:
+            continue
+        ratios = [stats[p] / baseline['scenarios'][name][p] for p in ['p50', 'p95', 'p99']]
+        regressed = ratios[0] > 1 + threshold or ratios[1] > 1 + threshold
+        regressions += regressed
+        print('{:<44} {:>9.2f}x {:>9.2f}x {:>9.2f}x{}'.format(name, *ratios, '  REGRESSION' if regressed else ''))
+    return regressions
+
+
+def _delays(values):
+    return {name: float(delay) for name, delay in (v.split('=') for v in values)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--only', choices=['analysis', 'backfill', 'search'], help='run only the analysis, backfill or search scenarios')
+    parser.add_argument('--requests', type=int, default=50, help='number of ids per analysis scenario')
+    parser.add_argument('--backfill-ids', type=int, default=200, help='number of ids of the backfill scenario')
+    parser.add_argument('--search-requests', type=int, default=20, help='number of requests per search query')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000], help='numbers of documents to search')
+    parser.add_argument('--search-engine', choices=['mongo', 'columns'], default=os.getenv('SEARCH_ENGINE', 'mongo'),
+                        help='search engine of ac-search, always the column store with mongomock')
+    parser.add_argument('--concurrency', type=int, default=1, help='number of requests handled at once, by forked processes')
+    parser.add_argument('--delay', nargs='+', default=['essentia=0.2', 'confident-chord-estimator=0.5', 'sonic-annotator=0.3', 'instrument-identifier=0.3'],
+                        metavar='FUNCTION=SECONDS', help='delay of the stub backend functions')
+    parser.add_argument('--sequence-length', type=int, default=500, help='number of chords and beats in the canned outputs')
+    parser.add_argument('--port', type=int, default=18080, help='port of the stub gateway')
+    parser.add_argument('--minio', action='store_true', help='download audio through the MinIO audio cache')
+    parser.add_argument('--database', default='ac_analysis_benchmark')
+    parser.add_argument('--results-dir', default=os.path.join(benchmarks_dir, 'results'))
+    parser.add_argument('--compare', help='results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative latency increase reported as regression')
+    parser.add_argument('--verbose', action='store_true', help='show the logs of the handlers')
+    args = parser.parse_args()
+
+    if os.getenv('MONGO_CONNECTION'):
+        connect = lambda: pymongo.MongoClient(os.getenv('MONGO_CONNECTION'))[args.database]
+    else:
+        import mongomock
+        if args.concurrency > 1:
+            parser.error('Concurrent requests need a MongoDB server in MONGO_CONNECTION')
+        # mongomock lacks aggregation operators used by the mongo search engine
+        args.search_engine = 'columns'
+        mongomock_db = mongomock.MongoClient()[args.database]
+        connect = lambda: mongomock_db
+    db = connect()
+
+    gateway = StubGateway(args.port, _delays(args.delay), args.sequence_length)
+    threading.Thread(target=gateway.serve_forever, daemon=True).start()
+    os.environ['GATEWAY_URL'] = 'http://127.0.0.1:{}'.format(args.port)
+    os.environ['PCM_CACHE_DIR'] = tempfile.mkdtemp(prefix='pcm-')
+
+    results = {'date': datetime.utcnow().isoformat() + 'Z', 'settings': vars(args), 'scenarios': {}}
+    try:
+        results['commit'] = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repo_dir, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    runs = []
+    if args.only in [None, 'analysis', 'backfill']:
+        analysis_handler = load_analysis(os.environ['GATEWAY_URL'], args.minio)
+        analysis_handler._get_db = lambda: db
+        if args.only != 'backfill':
+            runs.append(analysis_scenarios(analysis_handler, db, args, connect))
+        runs.append(backfill_scenarios(analysis_handler, db, args))
+    if args.only in [None, 'search']:
+        search_handler = search_engines.handler
+        search_handler._get_db = lambda: db
+        search_handler._search_engine = args.search_engine
+        runs.append(search_scenarios(search_handler, db, args, connect))
+
+    print('{:<44} {:>8} {:>6} {:>10} {:>10} {:>10} {:>10}'.format('scenario', 'requests', 'errors', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)', 'req/s'))
+    with contextlib.redirect_stderr(sys.stderr if args.verbose else open(os.devnull, 'w')):
+        for name, stats in (s for run in runs for s in run):
+            results['scenarios'][name] = stats
+            print('{:<44} {:>8} {:>6} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f}'.format(
+                name, stats['requests'], stats['errors'], 1000 * stats['p50'], 1000 * stats['p95'], 1000 * stats['p99'], stats['throughput']), flush=True)
+    gateway.shutdown()
+
+    os.makedirs(args.results_dir, exist_ok=True)
+    results_path = os.path.join(args.results_dir, 'end_to_end-{}.json'.format(datetime.utcnow().strftime('%Y%m%dT%H%M%S')))
+    with open(results_path, 'w') as f:
+        json.dump(results, f, indent=1, default=float)
+    print('Results stored in {}'.format(results_path))
+    failed = [name for name, stats in results['scenarios'].items() if stats['errors']]
+    if failed:
+        print('Errors in {}'.format(', '.join(failed)))
+    regressions = 0
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+    sys.exit(1 if failed or regressions else 0)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""Compare the direct JSON-LD builder of ac-analysis with the former rdflib round trip
+
+Converts synthetic chord and beat results of increasing length both ways, checks that both give
+isomorphic RDF graphs and reports the time each conversion takes, including json.dumps.
+
+    python3 benchmarks/ld_converter.py --lengths 1000 5000
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+from rdflib import Graph
+from rdflib.compare import isomorphic
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'ac-analysis'))
+import ld_converter
+
+
+def chords_result(rng, length):
+    labels = ['{}{}'.format(r, t) for r in ['A', 'Bb', 'B', 'C', 'Db', 'D', 'Eb', 'E', 'F', 'Gb', 'G', 'Ab'] for t in ['maj', 'min', '7']]
+    return {'id': 'jamendo-tracks:1', 'confidence': rng.random(), 'duration': length * 0.5,
+            'chordSequence': [{'start': i * 0.5, 'end': (i + 1) * 0.5, 'label': rng.choice(labels)} for i in range(length)]}
+
+
+def beats_result(rng, length):
+    return {'id': 'jamendo-tracks:1', 'file_metadata': {}, 'annotations': [{'namespace': 'beat', 'data': [
+        {'time': i * 0.5 + rng.random() * 0.01, 'duration': 0.0, 'value': None, 'confidence': None} for i in range(length)]}]}
+
+
+def rdflib_round_trip(descriptor, result_dict):
+    if descriptor == 'chords':
+        serialised = ld_converter.convert_chords(result_dict, 'json-ld')
+    else:
+        serialised = ld_converter.convert_jams(result_dict, 'json-ld', descriptor)
+    return ld_converter.json_sort(json.loads(serialised),
+        [["@context", "@graph", "*"],
+         ["*"],
+         ["@id", "@type", "timeline:start", "timeline:end", "timeline:duration", "rdfs:label", "*"]
+        ])
+
+
+def timed(function, repeats):
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        durations.append(time.perf_counter() - start)
+    return result, sorted(durations)[len(durations) // 2]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--lengths', type=int, nargs='+', default=[100, 1000, 5000])
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    print('{:<16} {:>8} {:>12} {:>12} {:>8} {:>11}'.format('descriptor', 'length', 'rdflib (ms)', 'direct (ms)', 'speedup', 'isomorphic'))
+    for descriptor, make_result in [('chords', chords_result), ('beats-beatroot', beats_result)]:
+        for length in args.lengths:
+            result_dict = make_result(rng, length)
+            old, old_time = timed(lambda: json.dumps(rdflib_round_trip(descriptor, result_dict)), args.repeats)
+            new, new_time = timed(lambda: json.dumps(ld_converter.convert(descriptor, result_dict, 'json-ld')), args.repeats)
+            equivalent = isomorphic(Graph().parse(data=old, format='json-ld'), Graph().parse(data=new, format='json-ld'))
+            print('{:<16} {:>8} {:>12.1f} {:>12.1f} {:>7.0f}x {:>11}'.format(
+                descriptor, length, 1000 * old_time, 1000 * new_time, old_time / new_time, str(equivalent)))
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""Compare the MongoDB aggregation and the in-memory column store search engines of ac-search
+
+Fills a separate database of the MongoDB server given by MONGO_CONNECTION with a synthetic
+descriptors collection, checks that both engines return the same results for a set of queries
+and reports the time each engine takes per query.
+
+    MONGO_CONNECTION=mongodb://localhost:27017 python3 benchmarks/search_engines.py --num-docs 1000000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import importlib.util
+from datetime import datetime
+import pymongo
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+spec = importlib.util.spec_from_file_location('ac_search', os.path.join(repo_dir, 'ac-search', '__init__.py'),
+                                              submodule_search_locations=[os.path.join(repo_dir, 'ac-search')])
+sys.modules['ac_search'] = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(sys.modules['ac_search'])
+sys.path.insert(0, os.path.join(repo_dir, 'ac-analysis'))
+from ac_search import handler
+from ac_search.column_store import chord_labels
+import search_fields
+
+
+queries = [
+    {'tempo': '>150'},
+    {'tempo': '<=80', 'providers': 'jamendo-tracks'},
+    {'tempo': '118-122'},
+    {'tempo': '120 -2%', 'tuning': ''},
+    {'tuning': '>=445'},
+    {'global-key': 'Aminor'},
+    {'global-key': 'major', 'providers': 'freesound-sounds,europeana-res'},
+    {'global-key': '', 'tempo': ''},
+    {'chords': 'Cmaj-Amin-Fmaj-Gmaj,80%'},
+    {'chords': 'Dmin,20%', 'tempo': '100-140'},
+]
+pages = [(10, 0), (10, 1000)]
+_providers = ['jamendo-tracks', 'freesound-sounds', 'europeana-res']
+_keys = ['A', 'A#', 'B', 'C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#']
+
+
+def synthetic_document(rng, i):
+    provider = rng.choice(_providers)
+    essentia = {'rhythm': {'bpm': rng.uniform(60, 180)}, 'tonal': {'tuning_frequency': rng.gauss(440, 3)}}
+    for variant in ['edma', 'krumhansl', 'temperley']:
+        essentia['tonal']['key_{}'.format(variant)] = {'key': rng.choice(_keys), 'scale': rng.choice(['major', 'minor']), 'strength': rng.random()}
+    labels = rng.sample(chord_labels, rng.randint(1, 8))
+    weights = [rng.random() for _ in labels]
+    chords = {'confidence': rng.random(), 'duration': 200., 'distinctChords': len(labels),
+              'chordSequence': [{'start': 0., 'end': 200., 'label': labels[0]}],
+              'chordRatio': {label: w / sum(weights) for label, w in zip(labels, weights)}}
+    doc = {'_id': '{}:{}'.format(provider, i), 'provider': provider, 'updated': datetime.utcnow(),
+           'essentia-music': essentia, 'chords': chords, 'search': {}}
+    for descriptor, result in [('essentia-music', essentia), ('chords', chords)]:
+        for field, value in search_fields.search_fields(descriptor, result).items():
+            doc['search'][field.split('.', 1)[1]] = value
+    return doc
+
+
+def fill(db, num_docs, batch_size=10000):
+    db.descriptors.drop()
+    rng = random.Random(0)
+    for start in range(0, num_docs, batch_size):
+        db.descriptors.insert_many([synthetic_document(rng, i) for i in range(start, min(start + batch_size, num_docs))], ordered=False)
+    search_fields.create_indexes(db)
+
+
+def timed(function, repeats):
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        durations.append(time.perf_counter() - start)
+    return result, sorted(durations)[len(durations) // 2]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--num-docs', type=int, default=1000000)
+    parser.add_argument('--database', default='ac_analysis_benchmark')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--reuse', action='store_true', help='reuse the collection of a previous run')
+    args = parser.parse_args()
+
+    db = pymongo.MongoClient(os.getenv('MONGO_CONNECTION'))[args.database]
+    if not args.reuse:
+        start = time.perf_counter()
+        fill(db, args.num_docs)
+        print('Inserted {} documents in {:.1f}s'.format(args.num_docs, time.perf_counter() - start))
+    handler._get_db = lambda: db
+    handler._search_engine = 'columns'
+    _, load_time = timed(lambda: handler._get_column_store().refresh(force=True), 1)
+    print('Loaded column store in {:.1f}s'.format(load_time))
+
+    print('{:<60} {:>12} {:>12} {:>8}'.format('query', 'mongo (ms)', 'columns (ms)', 'equal'))
+    for query in queries:
+        for num_results, offset in pages:
+            handler._search_engine = 'mongo'
+            mongo_results, mongo_time = timed(lambda: handler.search(query, num_results, offset), args.repeats)
+            handler._search_engine = 'columns'
+            column_results, column_time = timed(lambda: handler.search(query, num_results, offset), args.repeats)
+            print('{:<60} {:>12.1f} {:>12.1f} {:>8}'.format('{} /{}/{}'.format(query, num_results, offset),
+                  1000 * mongo_time, 1000 * column_time, str(mongo_results == column_results)))
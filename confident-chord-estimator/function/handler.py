@@ -8,8 +8,13 @@ from scipy.linalg import circulant
 import itertools
 import os
 import os.path
+import queue
 import requests
-from collections import defaultdict
+import threading
+import contextlib
+import subprocess
+import multiprocessing
+import scipy.io.wavfile
 from hiddini import HMMTemplateCosSim
 # import io
 
@@ -26,6 +31,13 @@ type_templates = np.array([[1, 0, 0, 0, 1, 0, 0, 1, 0, 0, 0, 0],
 chord_types = ['maj', 'min', '7', 'maj7', 'min7']
 chromas = ['A', 'Bb', 'B', 'C', 'Db', 'D', 'Eb', 'E', 'F', 'Gb', 'G', 'Ab']
 chord_self_prob = 0.1
+# Recordings are decoded and analysed in chunks of this many seconds to bound the memory use, 0 for one go
+chunk_duration = float(os.getenv('CHUNK_DURATION', 120))
+# madmom and hiddini are not known to be thread-safe, so every request of the long-lived worker takes
+# one of this many copies of the model for itself
+model_instances = int(os.getenv('MODEL_INSTANCES', 1))
+# Processes decoding the chromagrams of batches, 0 for one per CPU
+decoding_workers = int(os.getenv('DECODING_WORKERS', 0))
 
 
 def squash_timed_labels(start_times, end_times, labels):
@@ -38,48 +50,214 @@ def squash_timed_labels(start_times, end_times, labels):
 
 
 class MadMomDeepChromaExtractor:
-    def __init__(self, samplerate, frame_size, step_size):
+    def __init__(self, samplerate, frame_size, step_size, chunk_frames=0):
         self.samplerate = samplerate
         self.frame_size = frame_size
         self.step_size = step_size
+        self.chunk_frames = chunk_frames
         if samplerate != 44100 or frame_size != 8192 or step_size != 4410:
             raise ValueError('Parameter values not supported')
         self.frame_cutter = madmom.audio.FramedSignalProcessor(frame_size=frame_size, hop_size=step_size)
         self.extractor = madmom.audio.chroma.DeepChromaProcessor(num_channels=1)
+        # The network predicts every frame independently from its own spectrogram context, so the
+        # contexts of several files can be stacked and passed through the network at once
+        self.context_extractor = madmom.processors.SequentialProcessor(self.extractor.processors[:-1])
+        self.network = self.extractor.processors[-1]
+        # Spectrogram frames on either side of a frame that make up its context
+        self.context_frames = 7
     
     def get_frame_times(self, chromagram):
         start_times = self.step_size / self.samplerate * np.arange(len(chromagram)) - self.frame_size/(2*self.samplerate)
         return start_times, start_times+self.frame_size/self.samplerate
 
     def __call__(self, audio_file):
-        signal = madmom.audio.Signal(audio_file, num_channels=1)
-        duration = signal.num_samples / signal.sample_rate
-        framed_signal = self.frame_cutter(signal)
-        frame_spls = framed_signal.sound_pressure_level()
-        chromagram = self.extractor(signal)
-        chromagram = np.roll(chromagram, 3, axis=1)
-        return chromagram, self.get_frame_times(chromagram), duration, frame_spls
+        chromagrams = []
+        frame_spls = []
+        for contexts, spls, duration in self._frame_chunks(audio_file):
+            chromagrams.append(self.network(contexts))
+            frame_spls.append(spls)
+        chromagram = np.roll(np.concatenate(chromagrams), 3, axis=1)
+        return chromagram, self.get_frame_times(chromagram), duration, np.concatenate(frame_spls)
+
+    def batch(self, audio_files):
+        """Extract the chromagrams of several files with a single pass through the network"""
+        contexts = []
+        durations = []
+        frame_spls = []
+        for audio_file in audio_files:
+            chunks = list(self._frame_chunks(audio_file))
+            contexts.append(np.concatenate([c for c, _, _ in chunks]))
+            frame_spls.append(np.concatenate([spls for _, spls, _ in chunks]))
+            durations.append(chunks[-1][2])
+        chromagrams = np.split(self.network(np.concatenate(contexts)), np.cumsum([len(c) for c in contexts])[:-1])
+        return [(np.roll(chromagram, 3, axis=1), self.get_frame_times(chromagram), duration, spls)
+                for chromagram, duration, spls in zip(chromagrams, durations, frame_spls)]
+
+    def _frame_chunks(self, audio_file):
+        """Yield the network input and sound pressure level of the frames of an audio file, together with
+        the duration read so far, in one go or in chunks of chunk_frames frames"""
+        if not self.chunk_frames:
+            signal = madmom.audio.Signal(audio_file, num_channels=1)
+            yield self.context_extractor(signal), self.frame_cutter(signal).sound_pressure_level(), signal.num_samples / signal.sample_rate
+            return
+        for signal, offset, start, stop in self._signal_chunks(audio_file):
+            yield (self.context_extractor(signal)[start:stop], self.frame_cutter(signal).sound_pressure_level()[start:stop],
+                   (offset + signal.num_samples) / self.samplerate)
+
+    def _signal_chunks(self, audio_file):
+        """Yield overlapping chunks of the signal, with the range of frames of each chunk to keep
+
+        A chunk starts on a frame boundary and extends beyond the frames it keeps by the context of the
+        network and half a frame, such that the kept frames are equal to those of the whole signal.
+        """
+        # Frames of the chunk that reach before its first sample, on top of the context
+        edge_frames = int(np.ceil(self.frame_size / 2 / self.step_size))
+        samples = read_samples(audio_file, self.samplerate, self.chunk_frames * self.step_size)
+        buffer = None
+        buffer_start = 0
+        exhausted = False
+        start = 0
+        while True:
+            stop = start + self.chunk_frames
+            end = (stop - 1 + self.context_frames) * self.step_size + self.frame_size // 2
+            while not exhausted and (buffer is None or buffer_start + len(buffer) < end):
+                block = next(samples, None)
+                if block is None:
+                    exhausted = True
+                else:
+                    buffer = block if buffer is None else np.concatenate((buffer, block))
+            if exhausted:
+                num_samples = buffer_start + (0 if buffer is None else len(buffer))
+                stop = min(stop, int(np.ceil(num_samples / self.step_size)))
+                end = min((stop - 1 + self.context_frames) * self.step_size + self.frame_size // 2, num_samples)
+            if start >= stop:
+                return
+            first = max(start - self.context_frames - edge_frames, 0)
+            buffer = buffer[first * self.step_size - buffer_start:]
+            buffer_start = first * self.step_size
+            signal = madmom.audio.Signal(buffer[:end - buffer_start], sample_rate=self.samplerate, num_channels=1)
+            yield signal, buffer_start, start - first, stop - first
+            start = stop
+
+
+def read_samples(audio_file, samplerate, block_size):
+    """Yield the samples of an audio file in blocks of block_size samples
+
+    Wave files at the right sample rate are memory mapped like madmom does, other files are decoded by
+    ffmpeg into a pipe instead of memory.
+    """
+    try:
+        file_samplerate, samples = scipy.io.wavfile.read(audio_file, mmap=True)
+    except ValueError:
+        file_samplerate = None
+    if file_samplerate == samplerate:
+        for start in range(0, len(samples), block_size):
+            yield samples[start:start + block_size]
+        return
+    process = subprocess.Popen(['ffmpeg', '-v', 'quiet', '-i', audio_file, '-f', 's16le', '-ac', '1',
+                                '-ar', str(samplerate), 'pipe:1'], stdout=subprocess.PIPE)
+    try:
+        while True:
+            block = process.stdout.read(2 * block_size)
+            if not block:
+                break
+            yield np.frombuffer(block, dtype=np.int16)
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+    if returncode != 0:
+        raise ValueError('Could not decode {}'.format(audio_file))
 
 
 class ChordEstimator:
     def __init__(self, chromas, chord_types, type_templates, chroma_extractor, chord_self_prob):
         self.chords = np.array([''.join(x) for x in itertools.product(chromas, chord_types)])
         self.chroma_extractor = chroma_extractor
-        chord_templates = np.dstack([circulant(i) for i in type_templates]).reshape(len(chromas), -1).T
-        num_chords = len(self.chords)
-        trans_prob = np.full((num_chords, num_chords), (1-chord_self_prob)/(num_chords-1))
-        np.fill_diagonal(trans_prob, chord_self_prob)
-        self.hmm = HMMTemplateCosSim(chord_templates, trans_prob, np.full(num_chords, 1/num_chords))
+        self.hmm = chord_hmm(chromas, chord_types, type_templates, chord_self_prob)
     
     def __call__(self, audio_file):
         chromagram, (start_times, end_times), duration, frame_spls = self.chroma_extractor(audio_file)
         hmm_smoothed_state_indices, _, confidence = self.hmm.decode_with_PPD(chromagram.T)
         squashed_start_times, squashed_end_times, squashed_chord_labels = squash_timed_labels(start_times, end_times, self.chords[hmm_smoothed_state_indices])
         return squashed_start_times, squashed_end_times, squashed_chord_labels, confidence, duration, frame_spls
- 
 
-cp = MadMomDeepChromaExtractor(samplerate, block_size, step_size)
-hmm = ChordEstimator(chromas, chord_types, type_templates, cp, chord_self_prob)
+    def batch(self, audio_files, pool):
+        """Estimate the chords of several files, decoding the chromagrams in a pool of processes
+
+        The workers of the pool decode with their own copy of the HMM, see start_decoding_pool.
+        """
+        extracted = self.chroma_extractor.batch(audio_files)
+        decoded = pool.map(_decode, [chromagram for chromagram, _, _, _ in extracted], chunksize=1)
+        results = []
+        for (_, (start_times, end_times), duration, frame_spls), (hmm_smoothed_state_indices, _, confidence) in zip(extracted, decoded):
+            squashed_start_times, squashed_end_times, squashed_chord_labels = squash_timed_labels(start_times, end_times, self.chords[hmm_smoothed_state_indices])
+            results.append((squashed_start_times, squashed_end_times, squashed_chord_labels, confidence, duration, frame_spls))
+        return results
+
+
+def chord_hmm(chromas, chord_types, type_templates, chord_self_prob):
+    chord_templates = np.dstack([circulant(i) for i in type_templates]).reshape(len(chromas), -1).T
+    num_chords = len(chromas) * len(chord_types)
+    trans_prob = np.full((num_chords, num_chords), (1-chord_self_prob)/(num_chords-1))
+    np.fill_diagonal(trans_prob, chord_self_prob)
+    return HMMTemplateCosSim(chord_templates, trans_prob, np.full(num_chords, 1/num_chords))
+
+
+_decoding_hmm = None
+_decoding_pool = None
+_decoding_pool_lock = threading.Lock()
+
+
+def _init_decoder(*hmm_args):
+    global _decoding_hmm
+    _decoding_hmm = chord_hmm(*hmm_args)
+
+
+def _decode(chromagram):
+    return _decoding_hmm.decode_with_PPD(chromagram.T)
+
+
+def start_decoding_pool(num_workers=None):
+    """Start the pool of num_workers processes that decodes the chromagrams of batches, once for all batches
+
+    The HMM can't be pickled, so every worker builds its own in its initializer. The workers are started by
+    a fork server rather than by forking the worker, which may have other threads holding locks.
+    """
+    global _decoding_pool
+    with _decoding_pool_lock:
+        if _decoding_pool is None:
+            context = multiprocessing.get_context('forkserver')
+            context.set_forkserver_preload([__name__])
+            _decoding_pool = context.Pool(num_workers or decoding_workers or None, _init_decoder,
+                                          (chromas, chord_types, type_templates, chord_self_prob))
+    return _decoding_pool
+
+
+_models = queue.Queue()
+_models_lock = threading.Lock()
+_num_models = 0
+
+
+@contextlib.contextmanager
+def _model():
+    """Take a copy of the model that is not in use, loading another one while there are less than model_instances"""
+    global _num_models
+    with _models_lock:
+        if _models.empty() and _num_models < model_instances:
+            _num_models += 1
+            cp = MadMomDeepChromaExtractor(samplerate, block_size, step_size, int(chunk_duration * samplerate / step_size))
+            _models.put(ChordEstimator(chromas, chord_types, type_templates, cp, chord_self_prob))
+    hmm = _models.get()
+    try:
+        yield hmm
+    finally:
+        _models.put(hmm)
+
+
+def warm_up():
+    """Load a copy of the model before the long-lived worker takes requests"""
+    with _model():
+        pass
 
 
 def handle(audio_content):
@@ -96,12 +274,39 @@ def handle(audio_content):
         pass
     with open(audio_path, 'wb') as f:
         f.write(audio_content)
-    start_times, end_times, chord_labels, confidence, duration, frame_spls = hmm(audio_path)
+    return estimate_chords(audio_path)
+
+
+def estimate_chords(audio_path):
+    """Estimate the chords of an audio file and return them as a JSON string"""
+    with _model() as hmm:
+        start_times, end_times, chord_labels, confidence, duration, frame_spls = hmm(audio_path)
     # start_times, end_times, chord_labels, confidence, duration, frame_spls = hmm(io.BytesIO(audio_content))
-    response = {'confidence': confidence, 'duration': duration, 'chordSequence': [], 'chordRatio': defaultdict(int)}
-    for start, end, label in zip(start_times, end_times, chord_labels):
-        response['chordSequence'].append({'start': start, 'end': end, 'label': label})
-        response['chordRatio'][label] += end - start
-    response['chordRatio'].update({k: v/end for k, v in response['chordRatio'].items()})
+    return json.dumps(chords_response(start_times, end_times, chord_labels, confidence, duration))
+
+
+def estimate_chords_batch(audio_paths, num_workers=None):
+    """Estimate the chords of several audio files at once and return a JSON string per file
+
+    num_workers only applies when the decoding pool isn't started yet.
+    """
+    pool = start_decoding_pool(num_workers)
+    with _model() as hmm:
+        results = hmm.batch(audio_paths, pool)
+    return [json.dumps(chords_response(start_times, end_times, chord_labels, confidence, duration))
+            for start_times, end_times, chord_labels, confidence, duration, _ in results]
+
+
+def chords_response(start_times, end_times, chord_labels, confidence, duration):
+    response = {'confidence': confidence, 'duration': duration}
+    response['chordSequence'] = [{'start': start, 'end': end, 'label': label}
+                                 for start, end, label in zip(start_times.tolist(), end_times.tolist(), chord_labels.tolist())]
+    labels, first_indices, label_indices = np.unique(chord_labels, return_index=True, return_inverse=True)
+    ratios = np.bincount(label_indices, weights=end_times - start_times, minlength=len(labels))
+    if len(end_times):
+        ratios /= end_times[-1]
+    # In order of first occurrence
+    order = np.argsort(first_indices)
+    response['chordRatio'] = dict(zip(labels[order].tolist(), ratios[order].tolist()))
     response['distinctChords'] = len(response['chordRatio'])
-    return json.dumps(response)
+    return response
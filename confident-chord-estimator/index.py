@@ -1,18 +1,87 @@
 # Copyright (c) Alex Ellis 2017. All rights reserved.
 # Licensed under the MIT license. See LICENSE file in the project root for full license information.
 
+import io
+import os
 import sys
+import json
+import tarfile
+import tempfile
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
 from function import handler
 
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """Long-lived worker, such that the model is only loaded once for all requests"""
+    def do_POST(self):
+        audio_content = self._read_body()
+        path = self.path.split('?')[0]
+        try:
+            if path.rstrip('/') == '/batch':
+                ret = estimate_chords_archive(audio_content).encode()
+            else:
+                with tempfile.NamedTemporaryFile(suffix=os.path.splitext(path)[1]) as f:
+                    f.write(audio_content)
+                    f.flush()
+                    ret = handler.estimate_chords(f.name).encode()
+            status = 200
+        except Exception as e:
+            ret = str(e).encode()
+            status = 500
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json' if status == 200 else 'text/plain')
+        self.send_header('Content-Length', str(len(ret)))
+        self.end_headers()
+        self.wfile.write(ret)
+
+    do_GET = do_POST
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return b''.join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+
+def estimate_chords_archive(archive_content):
+    """Estimate the chords of all audio files in a tar archive as one batch, returned by file name"""
+    with tempfile.TemporaryDirectory() as directory:
+        with tarfile.open(fileobj=io.BytesIO(archive_content)) as archive:
+            members = [m for m in archive.getmembers() if m.isfile()]
+            audio_paths = []
+            for i, member in enumerate(members):
+                audio_paths.append(os.path.join(directory, '{}{}'.format(i, os.path.splitext(member.name)[1])))
+                with open(audio_paths[-1], 'wb') as f:
+                    f.write(archive.extractfile(member).read())
+        results = handler.estimate_chords_batch(audio_paths)
+    return '{' + ', '.join('{}: {}'.format(json.dumps(m.name), result) for m, result in zip(members, results)) + '}'
+
+
 if __name__ == "__main__":
-    st = sys.stdin.buffer.read()
-    try:
-        st = st.decode()
-    except UnicodeDecodeError:
-        pass
-    ret = handler.handle(st)
-    if ret != None:
-        if type(ret) == 'bytes':
-            sys.stdout.buffer.write(ret)
-        else:
-            sys.stdout.write(ret)
+    if '--serve' in sys.argv:
+        handler.warm_up()
+        handler.start_decoding_pool()
+        ThreadingHTTPServer(('127.0.0.1', int(os.getenv('port', 5000))), RequestHandler).serve_forever()
+    elif '--batch' in sys.argv:
+        audio_paths = sys.argv[sys.argv.index('--batch') + 1:]
+        for audio_path, ret in zip(audio_paths, handler.estimate_chords_batch(audio_paths)):
+            sys.stdout.write('{}\t{}\n'.format(audio_path, ret))
+    else:
+        st = sys.stdin.buffer.read()
+        ret = handler.handle(st)
+        if ret != None:
+            if isinstance(ret, bytes):
+                sys.stdout.buffer.write(ret)
+            else:
+                sys.stdout.write(ret)